@@ -2,6 +2,7 @@ from rareSim import sparse
 import random
 import sys
 import argparse
+from header import load_column_index
 
 
 def get_args():
@@ -17,6 +18,10 @@ def get_args():
                         required=True,
                         help='Ouput sparse matrix path')
 
+    parser.add_argument('--csc',
+                        action='store_true',
+                        help='Also write the column index of the sparse matrix to <output>.csc')
+
     args = parser.parse_args()
 
     return args
@@ -25,5 +30,7 @@ def main():
     args = get_args()
     M = sparse(args.input_file)
     M.write(args.output_file)
+    if args.csc:
+        load_column_index(args.output_file, M)
 
 if __name__ == '__main__': main()
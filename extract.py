@@ -1,5 +1,6 @@
 import random
 import argparse
+from header import load_column_index
 
 
 def get_args():
@@ -29,15 +30,29 @@ def get_args():
 
     return args
 
+def extract_sparse(args):
+    C = load_column_index(args.input_file)
+    size = C.num_rows()
+    columnsToExtract = random.sample(range(0, size), args.num)
+    extracted = set(columnsToExtract)
+    otherColumns = [i for i in range(size) if i not in extracted]
+    columnsToExtract.sort()
+    C.subset_cols(columnsToExtract).write(f'{args.output_file}-sample')
+    C.subset_cols(otherColumns).write(f'{args.output_file}-remainder')
+
 def main():
     args = get_args()
     random.seed(args.seed)
+    if args.input_file.endswith('.sm'):
+        extract_sparse(args)
+        return
     with open(args.input_file) as f:
         line = f.readline()
         columns = line.split()
     size = len(columns)
     columnsToExtract = random.sample(range(0, size), args.num)
-    otherColumns = [i for i in range(size) if i not in columnsToExtract]
+    extracted = set(columnsToExtract)
+    otherColumns = [i for i in range(size) if i not in extracted]
     columnsToExtract.sort()
     with open(f'{args.output_file}-sample', 'w') as s:
         with open(f'{args.output_file}-remainder', 'w') as r:
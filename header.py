@@ -1,8 +1,36 @@
+from rareSim import sparse, philox_uniform, keyed_sample
 import argparse
+import copy
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
 from os import SEEK_END
 import random
 import gzip
-from heapq import merge
+import struct
+import zlib
+from array import array
+from heapq import merge, nsmallest
+from itertools import groupby
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Source matrix rows per gzip member of a hap file written by write_hap
+HAP_BLOCK_ROWS = 1000
+
+# First word of .sm files whose column indices are narrower than 32 bits
+# (SPARSE_MATRIX_MAGIC in lists.h)
+SPARSE_MATRIX_MAGIC = 0xFFFFFFFF
+
+# Purposes of the random streams drawn for each row by RowStreams
+STREAM_REMOVE = 0
+STREAM_ADD = 1
+STREAM_ALLELE_COUNT = 2
+STREAM_ALLELES = 3
+STREAM_PROB = 4
 
 class Error(Exception):
     """Base class for other exceptions"""
@@ -20,6 +48,162 @@ class MissingProbs(Error):
     """Raised when legend is missing probs column"""
     pass
 
+class ChecksumMismatch(Error):
+    """Raised when a pruning plan was made from a different sparse matrix"""
+    pass
+
+class ProgressMismatch(Error):
+    """Raised when resuming a hap file that was started from different
+    inputs"""
+    pass
+
+
+class RowStreams:
+    """Counter-based (Philox4x32-10) random streams keyed by seed and
+    replicate, with a separate stream for every row and purpose.
+
+    A row's draws do not depend on which other rows are drawn for, or in
+    what order, so splitting the rows across threads, processes or shards
+    gives the same result as a single sequential run with the same seed.
+    """
+
+    def __init__(self, seed, replicate=0):
+        self.seed = seed
+        self.replicate = replicate
+
+    def uniform(self, row, purpose, counter=0):
+        return philox_uniform(self.seed, self.replicate, row, purpose, counter)
+
+    def sample(self, row, purpose, n, k):
+        """Sorted sample of k of the positions 0..n-1"""
+        return keyed_sample(n, k, self.seed, self.replicate, row, purpose)
+
+    def sample_rows(self, rows, k, purpose, counter=0):
+        """Sample of k of rows without replacement: the rows with the
+        smallest draws"""
+        return nsmallest(k, rows,
+                         key=lambda row: (self.uniform(row, purpose, counter), row))
+
+
+class RowSizes:
+    """Row sizes of a sparse matrix, read from the header and cumulative size
+    index of a .sm file without loading any of the row data.
+
+    Provides the part of the rareSim.sparse interface that binning and
+    pruning use (num_rows, num_cols, row_num and prune_row), so it can be
+    passed to assign_bins and prune_bins in place of a loaded matrix.
+    prune_row lowers the row's allele count and records which of the row's
+    alleles (by position in the row) were kept in selections, so the pruned
+    rows can be materialized later from a pruning plan. The kept alleles are
+    drawn from streams if given, otherwise from the random module.
+    """
+
+    def __init__(self, path, streams=None):
+        with open(path, 'rb') as f:
+            rows, self.cols = struct.unpack('II', f.read(8))
+            # Matrices with narrower column indices start with a marker and
+            # the index width
+            if rows == SPARSE_MATRIX_MAGIC:
+                rows, self.cols = struct.unpack('II', f.read(8))
+            sizes = array('I')
+            sizes.fromfile(f, rows)
+
+        self.counts = array('I', [0] * rows)
+        last_size = 0
+        for row in range(rows):
+            self.counts[row] = sizes[row] - last_size
+            last_size = sizes[row]
+
+        self.selections = {}
+        self.streams = streams
+
+    def num_rows(self):
+        return len(self.counts)
+
+    def num_cols(self):
+        return self.cols
+
+    def row_num(self, row):
+        return self.counts[row]
+
+    def prune_row(self, row, num_prune):
+        if row >= len(self.counts) or self.counts[row] == 0:
+            return 0
+        if num_prune > self.counts[row]:
+            return 0
+        num_keep = self.counts[row] - num_prune
+        kept = self.selections.get(row, range(self.counts[row]))
+        if self.streams is None:
+            self.selections[row] = sorted(random.sample(kept, num_keep))
+        else:
+            self.selections[row] = [kept[k] for k in self.streams.sample(
+                    row, STREAM_ALLELES, len(kept), num_keep)]
+        self.counts[row] = num_keep
+        return self.counts[row]
+
+    def set_selection(self, row, kept):
+        self.selections[row] = kept
+        self.counts[row] = len(kept)
+
+    def copy(self, streams=None):
+        """Unpruned copy of the row sizes, which prunes with streams"""
+        M = copy.copy(self)
+        M.counts = array('I', self.counts)
+        M.selections = {}
+        M.streams = streams
+        return M
+
+
+class LRUCache:
+    """Least recently used cache of loaded inputs, holding at most budget
+    bytes by the sizes given for each entry. The most recently added entry
+    is always kept, even if it is larger than the budget.
+
+    Safe to share between threads. A value is loaded outside the lock, so
+    two threads missing on the same key may both load it; the first one
+    stored is kept.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """Value of key, calling load() for a (value, size) pair on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value, size = load()
+
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key][0]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.budget and len(self.entries) > 1:
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+        return value
+
+    def metrics(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'budget': self.budget}
+
 
 def get_bin(bins, val):
     for i in range(len(bins)):
@@ -27,7 +211,7 @@ def get_bin(bins, val):
             return i
     return i+1
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-m',
@@ -57,7 +241,6 @@ def get_args():
 
     parser.add_argument('-H',
                         dest='output_hap',
-                        required=True,
                         help='Output compress hap file')
 
     parser.add_argument('--f_only',
@@ -68,6 +251,21 @@ def get_args():
                         dest='syn_bins_only',
                         help='Input expected bin sizes for synonymous variants only')
     
+    parser.add_argument('--stratify',
+                        dest='stratify',
+                        help='Legend column whose values split the variants into independently pruned strata')
+
+    parser.add_argument('--strata_bins',
+                        dest='strata_bins',
+                        nargs='+',
+                        help='Input expected bin sizes for each stratum, given as <value>=<file>')
+
+    parser.add_argument('--processes',
+                        dest='processes',
+                        type=int,
+                        default=1,
+                        help='Number of strata to prune at the same time, each in its own process')
+
     parser.add_argument('-z',
                         action='store_true',
                         help='Rows of zeros are not removed')
@@ -84,11 +282,42 @@ def get_args():
                         action='store_true',
                         help='Rows in the legend marked with a 1 in the protected column will be accounted for but not pruned')
 
-    args = parser.parse_args()
+    parser.add_argument('--exact',
+                        action='store_true',
+                        help='Prune each bin to exactly its expected number of variants')
+
+    parser.add_argument('--plan-only',
+                        dest='plan_only',
+                        help='Bin and prune from the sparse matrix size index only ' + \
+                             'and write the pruning plan to this path instead of ' + \
+                             'the legend and hap files')
+
+    parser.add_argument('--plan',
+                        dest='plan',
+                        help='Also write the pruning plan to this path')
+
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        help='Random seed for replication of the pruning')
+
+    parser.add_argument('--replicate',
+                        dest='replicate',
+                        type=int,
+                        default=0,
+                        help='Replicate number, drawn as an independent random stream for the same seed')
+
+    parser.add_argument('--state',
+                        dest='state',
+                        help='State file of the previous run. Only the bins and hap ' + \
+                             'blocks affected by changed bin targets are recomputed, ' + \
+                             'and the state of this run is saved to it')
+
+    args = parser.parse_args(argv)
 
     return args
 
-def prune_bins(bin_h, bins, R, M):
+def prune_bins(bin_h, bins, R, M, streams=None):
     for bin_id in reversed(range(len(bin_h))):
 
 	# The last bin contains those variants with ACs 
@@ -96,41 +325,112 @@ def prune_bins(bin_h, bins, R, M):
         if bin_id == len(bins):
             continue
 
-        need = bins[bin_id][2]
-        have = len(bin_h[bin_id])
+        prune_bin(bin_h, bins, bin_id, R, M, streams)
 
-        if abs(have - need) > 3:
-            p_rem = 1 - float(need)/float(have)
-            row_ids_to_rem = []
-            for i in range(have):
+
+def prune_bin(bin_h, bins, bin_id, R, M, streams=None):
+    need = bins[bin_id][2]
+    have = len(bin_h[bin_id])
+
+    if have == 0:
+        return
+
+    if abs(have - need) > 3:
+        p_rem = 1 - float(need)/float(have)
+        row_ids_to_rem = []
+        for i in range(have):
+            if streams is None:
                 flip = random.uniform(0, 1)
-                if flip <= p_rem:
-                    row_ids_to_rem.append(bin_h[bin_id][i])
-            for row_id in row_ids_to_rem:
-                R.append(row_id)
-                bin_h[bin_id].remove(row_id)
-        elif have < need - 3:
-            if R < need - have:
-                raise Exception('ERROR: ' + 'Current bin has ' + str(have) \
-                         + ' variant(s). Model needs ' + str(need) \
-                         + ' variant(s). Only ' + str(len(R)) + ' variant(s)' \
-                         + ' are avaiable')
-
-            p_add = float(need - have)/float(len(R))
-
-            row_ids_to_add = []
-            for i in range(len(R)):
+            else:
+                flip = streams.uniform(bin_h[bin_id][i], STREAM_REMOVE)
+            if flip <= p_rem:
+                row_ids_to_rem.append(bin_h[bin_id][i])
+        for row_id in row_ids_to_rem:
+            R.append(row_id)
+            bin_h[bin_id].remove(row_id)
+    elif have < need - 3:
+        if R < need - have:
+            raise Exception('ERROR: ' + 'Current bin has ' + str(have) \
+                     + ' variant(s). Model needs ' + str(need) \
+                     + ' variant(s). Only ' + str(len(R)) + ' variant(s)' \
+                     + ' are avaiable')
+
+        p_add = float(need - have)/float(len(R))
+
+        row_ids_to_add = []
+        for i in range(len(R)):
+            if streams is None:
                 flip = random.uniform(0, 1)
-                if flip <= p_add:
-                    row_ids_to_add.append(R[i])
-            for row_id in row_ids_to_add:
-                num_to_keep = int(random.uniform(bins[bin_id][0],\
-                                                 bins[bin_id][1]))
-                num_to_rem = M.row_num(row_id) - num_to_keep
-                left = M.prune_row(row_id, num_to_rem)
-                assert num_to_keep == left
-                bin_h[bin_id].append(row_id)
-                R.remove(row_id)
+            else:
+                flip = streams.uniform(R[i], STREAM_ADD, bin_id)
+            if flip <= p_add:
+                row_ids_to_add.append(R[i])
+        for row_id in row_ids_to_add:
+            if streams is None:
+                u = random.uniform(0, 1)
+            else:
+                u = streams.uniform(row_id, STREAM_ALLELE_COUNT)
+            num_to_keep = int(bins[bin_id][0] + \
+                              u * (bins[bin_id][1] - bins[bin_id][0]))
+            num_to_rem = M.row_num(row_id) - num_to_keep
+            left = M.prune_row(row_id, num_to_rem)
+            assert num_to_keep == left
+            bin_h[bin_id].append(row_id)
+            R.remove(row_id)
+
+
+def prune_bins_exact(bin_h, bins, R, M, streams=None):
+    """Prune each bin to exactly its expected number of variants (rounded).
+
+    Surplus rows are removed by sampling exactly have - need rows without
+    replacement, and missing rows are filled by sampling exactly
+    need - have rows from R, whose alleles are then pruned down to a count
+    within the bin. Samples are drawn from streams if given, otherwise from
+    the random module.
+    """
+    for bin_id in reversed(range(len(bins))):
+        prune_bin_exact(bin_h, bins, bin_id, R, M, streams)
+
+
+def prune_bin_exact(bin_h, bins, bin_id, R, M, streams=None):
+    need = int(round(bins[bin_id][2]))
+    rows = bin_h.setdefault(bin_id, [])
+    have = len(rows)
+
+    if have > need:
+        if streams is None:
+            row_ids_to_rem = random.sample(rows, have - need)
+        else:
+            row_ids_to_rem = streams.sample_rows(rows, have - need,
+                                                 STREAM_REMOVE)
+        rem = set(row_ids_to_rem)
+        rows[:] = [row_id for row_id in rows if row_id not in rem]
+        R.extend(row_ids_to_rem)
+    elif have < need:
+        if len(R) < need - have:
+            raise Exception('ERROR: ' + 'Current bin has ' + str(have) \
+                     + ' variant(s). Model needs ' + str(need) \
+                     + ' variant(s). Only ' + str(len(R)) + ' variant(s)' \
+                     + ' are avaiable')
+
+        if streams is None:
+            row_ids_to_add = random.sample(R, need - have)
+        else:
+            row_ids_to_add = streams.sample_rows(R, need - have,
+                                                 STREAM_ADD, bin_id)
+        for row_id in row_ids_to_add:
+            if streams is None:
+                num_to_keep = random.randint(bins[bin_id][0], bins[bin_id][1])
+            else:
+                u = streams.uniform(row_id, STREAM_ALLELE_COUNT)
+                num_to_keep = bins[bin_id][0] + \
+                        int(u * (bins[bin_id][1] - bins[bin_id][0] + 1))
+            num_to_rem = M.row_num(row_id) - num_to_keep
+            left = M.prune_row(row_id, num_to_rem)
+            assert num_to_keep == left
+            rows.append(row_id)
+        add = set(row_ids_to_add)
+        R[:] = [row_id for row_id in R if row_id not in add]
 
 
 def print_bin(bin_h, bins):
@@ -182,7 +482,7 @@ def get_split(args):
     fun_only = False
     syn_only = False
     
-    if args.exp_bins is None and not args.prob:
+    if args.exp_bins is None and not args.prob and args.stratify is None:
         if args.exp_fun_bins is not None \
             and args.exp_syn_bins is not None:
             func_split = True
@@ -196,7 +496,7 @@ def get_split(args):
                      'and --synonymous_bins')
     return func_split, fun_only, syn_only
 
-def verify_legend(legend, legend_header, M, split, probs):
+def verify_legend(legend, legend_header, M, split, probs, stratify=None):
     if split and 'fun' not in legend_header and not probs:
         raise MissingColumn('If variants are split by functional/synonymous ' + \
                  'the legend file must have a column named "fun" ' + \
@@ -208,6 +508,10 @@ def verify_legend(legend, legend_header, M, split, probs):
     if probs and 'prob' not in legend_header:
         raise MissingProbs('The legend file needs to have a "prob" column ' + \
                 'to indicate the pruning probability of a given row ')
+
+    if stratify is not None and stratify not in legend_header:
+        raise MissingColumn(f'The legend file needs to have a "{stratify}" ' + \
+                'column to split the variants into strata')
     
 
 
@@ -247,7 +551,7 @@ def assign_bins(M, bins, legend, func_split, fun_only, syn_only, z):
     return bin_h
 
 
-def write_legend(all_kept_rows, input_legend, output_legend):
+def write_legend(all_kept_rows, input_legend, output_legend, start=0):
     header = None
     file_i = 0
     row_i = 0
@@ -261,7 +565,9 @@ def write_legend(all_kept_rows, input_legend, output_legend):
             f.write(l)
             header = True
         else:
-            if file_i == all_kept_rows[row_i]:
+            if file_i < start:
+                pass
+            elif file_i == all_kept_rows[row_i]:
                 f.write(l)
                 row_i+=1
             else:
@@ -269,15 +575,31 @@ def write_legend(all_kept_rows, input_legend, output_legend):
             file_i+=1
 
 
-def write_hap(all_kept_rows, output_file, M):
-    step = int(len(all_kept_rows)/10)
-    i = 0
-
-    with gzip.open(output_file, 'wb') as f:
-        for row_i in all_kept_rows:
-            row = []
-            for col_i in range(M.row_num(row_i)):
-                row.append(M.get(row_i, col_i))
+def read_hap_progress(progress_file):
+    meta = {}
+    blocks = {}
+    offset = 0
+    with open(progress_file) as f:
+        for l in f:
+            A = l.split()
+            if l.startswith('#'):
+                meta.update(a.split('=', 1) for a in l[1:].rstrip().split('\t') if a)
+            # A line cut short by a crash is ignored
+            elif len(A) == 3 and l.endswith('\n'):
+                blocks[int(A[0])] = (offset, int(A[1]), int(A[2]))
+                offset = int(A[1])
+    return meta, blocks
+
+
+def write_hap_block(f, rows, M, selections):
+    with gzip.GzipFile(fileobj=f, mode='wb') as z:
+        for row_i in rows:
+            if row_i in selections:
+                row = [M.get(row_i, k) for k in selections[row_i]]
+            else:
+                row = []
+                for col_i in range(M.row_num(row_i)):
+                    row.append(M.get(row_i, col_i))
 
             O = ['0'] * M.num_cols()
 
@@ -285,16 +607,222 @@ def write_hap(all_kept_rows, output_file, M):
                 O[col_i] = '1'
 
             s = ' '.join(O) + '\n'
-            f.write(s.encode())
-
-            if (i % step == 0):
-                print('.', end='', flush=True)
+            z.write(s.encode())
+
+
+def write_hap(all_kept_rows, output_file, M, selections=None, resume=False,
+              reuse=None, meta=None):
+    """Write the kept rows of M as a gzipped hap file.
+
+    Rows listed in selections only keep the alleles at the given positions
+    in the row. The file is written as one gzip member per HAP_BLOCK_ROWS
+    source rows, and every completed member is logged to
+    <output_file>.progress. With resume, a partial file is cut back to the
+    last completed member and writing continues from there. The progress
+    file is removed once the hap file is complete.
+
+    meta is an optional dict describing the inputs (such as the plan and
+    row range) and is recorded in the first line of the progress file. A
+    partial file started with a different meta is not resumed, and
+    ProgressMismatch is raised instead.
+
+    reuse is an optional (hap file, blocks, changed) tuple describing a
+    previous hap file: the members of blocks that are not in changed are
+    copied from it instead of being rewritten, and M is not used for them.
+
+    Returns the (start, end) byte offsets and the CRC of the member of each
+    block.
+    """
+    if selections is None:
+        selections = {}
+
+    meta = {} if meta is None else {k: str(v) for k, v in meta.items()}
+
+    progress_file = f'{output_file}.progress'
+    blocks = {}
+    done_block = -1
+    mode = 'wb'
+    # A missing output file is written from the first block, and blocks
+    # logged past the end of the file are written again
+    if resume and os.path.exists(progress_file) and os.path.exists(output_file):
+        size = os.path.getsize(output_file)
+        old_meta, old_blocks = read_hap_progress(progress_file)
+        blocks = {block: offsets for block, offsets in old_blocks.items()
+                  if offsets[1] <= size}
+        if blocks and old_meta != meta:
+            def describe(meta):
+                return ', '.join(f'{k}={v}' for k, v in meta.items()) or 'nothing'
+            raise ProgressMismatch(f"{output_file} was started from " + \
+                    f"{describe(old_meta)}, not {describe(meta)}. Remove it " + \
+                    f"and {progress_file} to write it again")
+        if blocks:
+            done_block = max(blocks)
+            with open(output_file, 'r+b') as f:
+                f.truncate(blocks[done_block][1])
+            mode = 'ab'
 
+    step = int(len(all_kept_rows)/10)
+    i = 0
 
-            i+=1
+    with open(output_file, mode) as f, \
+            open(progress_file, mode.replace('b', '')) as p:
+        if mode == 'wb':
+            p.write('#' + '\t'.join(f'{k}={v}' for k, v in meta.items()) + '\n')
+        for block, rows in groupby(all_kept_rows,
+                                   lambda row_i: row_i // HAP_BLOCK_ROWS):
+            rows = list(rows)
+            if block > done_block:
+                start = f.tell()
+                if reuse is not None and block in reuse[1] \
+                        and block not in reuse[2]:
+                    prev_start, prev_end, crc = reuse[1][block]
+                    with open(reuse[0], 'rb') as prev:
+                        prev.seek(prev_start)
+                        f.write(prev.read(prev_end - prev_start))
+                else:
+                    member = io.BytesIO()
+                    write_hap_block(member, rows, M, selections)
+                    crc = zlib.crc32(member.getvalue())
+                    f.write(member.getvalue())
+
+                f.flush()
+                blocks[block] = (start, f.tell(), crc)
+                p.write(f'{block}\t{f.tell()}\t{crc}\n')
+                p.flush()
+
+            for row_i in rows:
+                if step != 0 and (i % step == 0):
+                    print('.', end='', flush=True)
+                i+=1
+
+    os.remove(progress_file)
     print()
+    return blocks
+
+
+def verified_blocks(hap_file, blocks):
+    """The blocks (as returned by write_hap) whose members are still in
+    hap_file with the same size and CRC"""
+    size = os.path.getsize(hap_file)
+    verified = {}
+    with open(hap_file, 'rb') as f:
+        for block, (start, end, crc) in blocks.items():
+            if end > size:
+                continue
+            f.seek(start)
+            if zlib.crc32(f.read(end - start)) == crc:
+                verified[block] = (start, end, crc)
+    return verified
+
+
+def changed_blocks(kept_rows, selections, old_kept_rows, old_selections):
+    """Blocks of HAP_BLOCK_ROWS source rows whose kept rows or kept alleles
+    differ between two pruning results"""
+    def block_rows(kept_rows, selections):
+        blocks = {}
+        for row_i in kept_rows:
+            blocks.setdefault(row_i // HAP_BLOCK_ROWS, []).append(
+                    (row_i, selections.get(row_i)))
+        return blocks
+
+    new = block_rows(kept_rows, selections)
+    old = block_rows(old_kept_rows, old_selections)
+    return {block for block in set(new) | set(old)
+            if new.get(block) != old.get(block)}
+
+
+def load_column_index(sparse_matrix_file, M=None):
+    """Column index (transpose) of a sparse matrix, whose row i lists the
+    rows with an allele in column (haplotype) i.
+
+    The index is read from <sparse_matrix_file>.csc if that is newer than
+    the matrix. Otherwise it is built from M, loading the matrix if M is not
+    given, and saved to <sparse_matrix_file>.csc.
+    """
+    csc_file = f'{sparse_matrix_file}.csc'
+    if os.path.exists(csc_file) and \
+            os.path.getmtime(csc_file) >= os.path.getmtime(sparse_matrix_file):
+        C = sparse(None)
+        C.load(csc_file)
+        return C
+
+    if M is None:
+        M = sparse(None)
+        M.load(sparse_matrix_file)
+    C = M.transpose()
+    C.write(csc_file)
+    return C
+
+
+def matrix_checksum(sparse_matrix_file):
+    """CRC32 of the header and size index of a .sm file and of the file
+    size. Only these are read, so checking a plan against a matrix costs no
+    more than plan-only pruning. Matrices that differ only in their column
+    indices have the same checksum."""
+    with open(sparse_matrix_file, 'rb') as f:
+        head = f.read(8)
+        rows = struct.unpack('II', head)[0]
+        if rows == SPARSE_MATRIX_MAGIC:
+            head += f.read(8)
+            rows = struct.unpack('II', head[8:])[0]
+        head += f.read(4 * rows)
+        size = f.seek(0, SEEK_END)
+    crc = zlib.crc32(struct.pack('Q', size), zlib.crc32(head))
+    return f'{crc:08x}'
+
+
+def file_checksum(file_name):
+    """CRC32 of the whole file"""
+    crc = 0
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return f'{crc:08x}'
+
+
+def write_plan(all_kept_rows, plan_file, M, checksum, seed, replicate=0):
+    with open(plan_file, 'w') as f:
+        f.write(f'#rows={M.num_rows()}\tcols={M.num_cols()}' + \
+                f'\tchecksum={checksum}\tseed={seed}\treplicate={replicate}\n')
+        f.write('row\tnum_alleles\tkept_alleles\n')
+        for row_i in all_kept_rows:
+            kept = '.'
+            if row_i in M.selections:
+                kept = ','.join(str(k) for k in M.selections[row_i])
+            f.write(f'{row_i}\t{M.row_num(row_i)}\t{kept}\n')
 
 
+def read_plan(plan_file):
+    meta = {}
+    kept_rows = []
+    selections = {}
+
+    header = None
+    with open(plan_file) as f:
+        for l in f:
+            A = l.rstrip('\n').split('\t')
+
+            if l.startswith('#'):
+                meta.update(a.split('=', 1) for a in l[1:].rstrip().split('\t'))
+            elif header == None:
+                header = A
+            else:
+                row_i = int(A[0])
+                kept_rows.append(row_i)
+                if A[2] != '.':
+                    selections[row_i] = [int(k) for k in A[2].split(',') if k]
+
+    return meta, kept_rows, selections
+
+
+def verify_plan(meta, M, checksum):
+    if meta['checksum'] != checksum:
+        raise ChecksumMismatch("Plan was made from a sparse matrix with checksum " + \
+                f"{meta['checksum']}, but the given matrix has checksum {checksum}")
+    if int(meta['rows']) != M.num_rows():
+        raise DifferingLengths(f"Plan has {meta['rows']} rows and sparse matrix " + \
+                f"has {M.num_rows()} rows")
+
 
 def print_frequency_distribution(bins, bin_h, func_split, fun_only, syn_only):
     if func_split:
@@ -350,6 +878,213 @@ def get_all_kept_rows(bin_h, R, func_split, fun_only, syn_only, z, keep_protecte
     return all_kept_rows
 
 
+def read_strata_bins(strata_bins):
+    """Read the expected bin sizes of each stratum from a list of
+    <value>=<file> specs. Returns the stratum values, in the order given,
+    and their bins; a stratum's code is its index in both lists."""
+    categories = []
+    bins = []
+    for spec in strata_bins:
+        if '=' not in spec:
+            raise Exception(f'Stratum bins "{spec}" must be given as <value>=<file>')
+        category, expected_file_name = spec.split('=', 1)
+        if category in categories:
+            raise Exception(f'Bins for stratum "{category}" given more than once')
+        categories.append(category)
+        bins.append(read_expected(expected_file_name))
+    return categories, bins
+
+
+def assign_strata(M, bins, legend, column, categories, z):
+    """Group rows by (stratum, bin) in a single pass over the rows.
+
+    Rows are mapped to the integer code of their value in the legend
+    column. strata_h[code][bin_id] lists the rows of that stratum and bin,
+    with every bin of every stratum present. Rows whose value has no bins
+    are returned in other_rows and are kept without pruning. If column is
+    None, all rows are in the single stratum 0.
+    """
+    codes = {category: code for code, category in enumerate(categories)}
+    strata_h = [{bin_id: [] for bin_id in range(len(bins[code]) + 1)}
+                for code in range(len(categories))]
+    other_rows = []
+
+    for row_i in range(M.num_rows()):
+        row_num = M.row_num(row_i)
+
+        if row_num > 0 or z:
+            code = 0 if column is None else codes.get(legend[row_i][column])
+            if code is None:
+                other_rows.append(row_i)
+            else:
+                strata_h[code][get_bin(bins[code], row_num)].append(row_i)
+
+    return strata_h, other_rows
+
+
+def prune_stratum(bin_h, bins, M, streams, exact, previous, cached):
+    """Prune the bins of one stratum, with prune_stratum_cached if cached.
+    Returns the removed rows and, if cached, the results of each bin."""
+    R = []
+    if cached:
+        return R, prune_stratum_cached(bin_h, bins, R, M, streams, exact, previous)
+    prune = prune_bins_exact if exact else prune_bins
+    prune(bin_h, bins, R, M, streams)
+    return R, None
+
+
+def prune_stratum_job(bin_h, bins, M, *args):
+    """prune_stratum in a worker process, which also returns the pruned
+    bins and the kept alleles of the worker's copy of M"""
+    return prune_stratum(bin_h, bins, M, *args), bin_h, M.selections
+
+
+def run_strata(strata_h, bins, M, streams, exact, processes, previous, cached):
+    """Prune every stratum, in up to processes worker processes.
+
+    Workers prune copies of their stratum and of M (which must be a
+    RowSizes), and their bins and kept alleles are copied back. Strata hold
+    disjoint rows and all draws come from the per-row streams, so the
+    result does not depend on processes.
+    """
+    jobs = [(strata_h[code], bins[code], M, streams, exact,
+             None if previous is None else previous[code], cached)
+            for code in range(len(strata_h))]
+
+    if processes <= 1 or len(jobs) <= 1:
+        done = [prune_stratum(*job) for job in jobs]
+    else:
+        done = []
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for code, (result, bin_h, selections) in \
+                    enumerate(pool.map(prune_stratum_job, *zip(*jobs))):
+                strata_h[code].update(bin_h)
+                for row_id, kept in selections.items():
+                    M.set_selection(row_id, kept)
+                done.append(result)
+
+    return [R for R, results in done], [results for R, results in done]
+
+
+def prune_strata(strata_h, bins, M, streams, exact=False, processes=1):
+    """Prune the bins of every stratum, up to processes strata at a time.
+    Each stratum has its own list of removed rows, which is returned by
+    stratum code."""
+    return run_strata(strata_h, bins, M, streams, exact, processes,
+                      None, False)[0]
+
+
+def rows_digest(rows):
+    """Digest of a set of row ids, to compare them without storing them"""
+    return hashlib.sha1(array('I', sorted(rows)).tobytes()).hexdigest()
+
+
+def prune_stratum_cached(bin_h, bins, R, M, streams, exact, previous=None):
+    """Prune the bins of one stratum like prune_bins (or prune_bins_exact),
+    reusing the results of a previous run where they still hold.
+
+    previous is the (bins, results) of the previous run of the stratum,
+    where bin_h started from the same rows. A bin is recomputed only if its
+    target changed, or if it took rows from R and R now holds different
+    rows. All draws come from streams, so a reused bin is exactly what
+    recomputing it would give.
+
+    Returns the results of this run, by bin id: a digest (rows_digest) of
+    the rows in R when the bin was pruned, the rows it kept, removed and took from R (with their kept
+    alleles), and whether it was recomputed.
+    """
+    prune = prune_bin_exact if exact else prune_bin
+    results = {}
+
+    for bin_id in reversed(range(len(bins))):
+        r_in = rows_digest(R)
+        old = None
+        if previous is not None and bin_id < len(previous[0]) \
+                and list(previous[0][bin_id]) == list(bins[bin_id]):
+            old = previous[1][bin_id]
+
+        if old is not None and (not old['added'] or old['r_in'] == r_in):
+            bin_h[bin_id][:] = old['kept']
+            R.extend(old['removed'])
+            added = set()
+            for row_id, kept in old['added']:
+                M.set_selection(row_id, kept)
+                added.add(row_id)
+            R[:] = [row_id for row_id in R if row_id not in added]
+            results[bin_id] = dict(old, r_in=r_in, recomputed=False)
+            continue
+
+        rows = set(bin_h[bin_id])
+        prune(bin_h, bins, bin_id, R, M, streams)
+        kept = set(bin_h[bin_id])
+        results[bin_id] = {
+            'r_in': r_in,
+            'kept': list(bin_h[bin_id]),
+            'removed': [row_id for row_id in R if row_id in rows],
+            'added': [[row_id, M.selections.get(row_id)]
+                      for row_id in bin_h[bin_id] if row_id not in rows],
+            'recomputed': True}
+
+    return results
+
+
+def prune_strata_cached(strata_h, bins, M, streams, exact=False, processes=1,
+                        previous=None):
+    """prune_strata, reusing the per-bin results of a previous run
+    (previous[code] is the (bins, results) of stratum code) where they still
+    hold. Returns the removed rows and the new results of each stratum."""
+    return run_strata(strata_h, bins, M, streams, exact, processes,
+                      previous, True)
+
+
+def read_state(state_file):
+    with open(state_file) as f:
+        state = json.load(f)
+
+    # JSON object keys are strings
+    state['initial'] = [{int(bin_id): rows for bin_id, rows in stratum.items()}
+                        for stratum in state['initial']]
+    state['results'] = [{int(bin_id): result for bin_id, result in stratum.items()}
+                        for stratum in state['results']]
+    state['selections'] = {int(row_i): kept
+                           for row_i, kept in state['selections'].items()}
+    state['blocks'] = {int(block): tuple(offsets)
+                       for block, offsets in state['blocks'].items()}
+    return state
+
+
+def write_state(state_file, state):
+    # Written to a temporary file first so a failed run can not leave a
+    # partial state behind
+    with open(f'{state_file}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{state_file}.tmp', state_file)
+
+
+def print_strata_distribution(bins, strata_h, labels):
+    for code in range(len(labels)):
+        if code > 0:
+            print()
+        if labels[code] is not None:
+            print(labels[code])
+        # The bin of rows above the last bin is only listed when it has
+        # rows, as in print_frequency_distribution
+        bin_h = strata_h[code]
+        if not bin_h[len(bins[code])]:
+            bin_h = {bin_id: rows for bin_id, rows in bin_h.items()
+                     if bin_id < len(bins[code])}
+        print_bin(bin_h, bins[code])
+
+
+def get_strata_kept_rows(strata_h, R, other_rows, z, keep_protected, legend):
+    bin_h = {0: list(other_rows)}
+    for stratum in strata_h:
+        for rows in stratum.values():
+            bin_h[0] += rows
+    return get_all_kept_rows(bin_h, dict(enumerate(R)), False, False, False,
+                             z, keep_protected, legend)
+
+
 def get_expected_bins(args, func_split, fun_only, syn_only):
     bins = None
     if func_split:
@@ -362,4 +1097,62 @@ def get_expected_bins(args, func_split, fun_only, syn_only):
         bins = read_expected(args.fun_bins_only)
     else:
         bins = read_expected(args.exp_bins)
-    return bins
\ No newline at end of file
+    return bins
+
+
+def file_key(path):
+    """Cache key part for the current contents of a file"""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def cached(cache, key, load):
+    if cache is None:
+        return load()[0]
+    return cache.get(key, load)
+
+
+def load_legend(legend_file, cache=None):
+    """read_legend through cache, if given. The legend must not be changed."""
+    def load():
+        legend_header, legend = read_legend(legend_file)
+        size = sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row.values()))
+                   for row in legend)
+        return (legend_header, legend), size
+    return cached(cache, ('legend',) + file_key(legend_file), load)
+
+
+def load_sparse(sparse_matrix_file, cache=None):
+    """Loaded sparse matrix, through cache if given. The matrix must not be
+    changed."""
+    def load():
+        M = sparse(None)
+        M.load(sparse_matrix_file)
+        return M, M.nbytes()
+    return cached(cache, ('sparse',) + file_key(sparse_matrix_file), load)
+
+
+def load_row_sizes(sparse_matrix_file, streams=None, cache=None):
+    """RowSizes of a sparse matrix, through cache if given. Every call
+    returns its own copy to prune."""
+    def load():
+        M = RowSizes(sparse_matrix_file)
+        return M, M.counts.itemsize * len(M.counts)
+    return cached(cache, ('row_sizes',) + file_key(sparse_matrix_file),
+                  load).copy(streams)
+
+
+def load_strata(M, bins, legend, column, categories, z, files, cache=None):
+    """assign_strata of the unpruned M, through cache if given. files are
+    the sparse matrix and legend M and legend were read from. Every call
+    returns its own copy to prune."""
+    def load():
+        strata_h, other_rows = assign_strata(M, bins, legend, column,
+                                             categories, z)
+        size = 36 * (len(other_rows) + sum(len(rows) for stratum in strata_h
+                                          for rows in stratum.values()))
+        return (strata_h, other_rows), size
+    key = ('strata', file_key(files[0]), file_key(files[1]), column,
+           tuple(categories), tuple(tuple(map(tuple, b)) for b in bins), z)
+    strata_h, other_rows = cached(cache, key, load)
+    return copy.deepcopy(strata_h), list(other_rows)
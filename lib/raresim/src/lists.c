@@ -57,6 +57,82 @@ void reservoir_sample(uint32_t max, uint32_t N, uint32_t *R)
 }
 //}}}
 
+//{{{ counter-based random streams
+#define PHILOX_M0 0xD2511F53
+#define PHILOX_M1 0xCD9E8D57
+#define PHILOX_W0 0x9E3779B9
+#define PHILOX_W1 0xBB67AE85
+
+//{{{void philox4x32_10(uint32_t ctr[4], uint32_t key[2], uint32_t out[4])
+void philox4x32_10(uint32_t ctr[4], uint32_t key[2], uint32_t out[4])
+{
+    uint32_t c[4] = {ctr[0], ctr[1], ctr[2], ctr[3]};
+    uint32_t k[2] = {key[0], key[1]};
+
+    int r;
+    for (r = 0; r < 10; ++r) {
+        if (r > 0) {
+            k[0] += PHILOX_W0;
+            k[1] += PHILOX_W1;
+        }
+
+        uint64_t p0 = (uint64_t)PHILOX_M0 * c[0];
+        uint64_t p1 = (uint64_t)PHILOX_M1 * c[2];
+
+        uint32_t n[4];
+        n[0] = (uint32_t)(p1 >> 32) ^ c[1] ^ k[0];
+        n[1] = (uint32_t)p1;
+        n[2] = (uint32_t)(p0 >> 32) ^ c[3] ^ k[1];
+        n[3] = (uint32_t)p0;
+        memcpy(c, n, sizeof(c));
+    }
+
+    memcpy(out, c, sizeof(c));
+}
+//}}}
+
+//{{{double philox_uniform(uint32_t seed,
+double philox_uniform(uint32_t seed,
+                      uint32_t replicate,
+                      uint32_t row,
+                      uint32_t purpose,
+                      uint32_t counter)
+{
+    uint32_t ctr[4] = {row, purpose, counter, 0};
+    uint32_t key[2] = {seed, replicate};
+    uint32_t out[4];
+
+    philox4x32_10(ctr, key, out);
+
+    // 53 random bits, the same construction as Python's random.random()
+    uint64_t a = out[0] >> 5, b = out[1] >> 6;
+    return (a * 67108864.0 + b) * (1.0 / 9007199254740992.0);
+}
+//}}}
+
+//{{{void reservoir_sample_keyed(uint32_t max,
+void reservoir_sample_keyed(uint32_t max,
+                            uint32_t N,
+                            uint32_t *R,
+                            uint32_t seed,
+                            uint32_t replicate,
+                            uint32_t row,
+                            uint32_t purpose)
+{
+    uint32_t i;
+    for (i = 0; i < N; i++)
+        R[i] = i;
+
+    for (i = N; i < max; i++) {
+        uint32_t j = (uint32_t)(philox_uniform(seed, replicate, row, purpose, i)
+                                * (i + 1));
+        if ( j < N )
+            R[j] = i;
+    }
+}
+//}}}
+//}}}
+
 //{{{int uint32_t_compare( const void* a , const void* b )
 int uint32_t_compare( const void* a , const void* b )
 {
@@ -201,6 +277,110 @@ struct uint32_t_array *uint32_t_array_read(char *file_name)
 //}}}
 
 //{{{ uint32_t_sparse_matrix
+//{{{uint32_t sparse_matrix_width(uint32_t cols)
+/*
+ * Bytes needed to store every column index of a matrix with cols columns.
+ */
+uint32_t sparse_matrix_width(uint32_t cols)
+{
+    if (cols <= 0x10000)
+        return 2;
+    else if (cols <= 0x1000000)
+        return 3;
+    else
+        return 4;
+}
+//}}}
+
+//{{{static inline uint32_t sparse_row_get(struct uint32_t_array *ua,
+static inline uint32_t sparse_row_get(struct uint32_t_array *ua,
+                                      uint32_t width,
+                                      uint32_t i)
+{
+    uint8_t *p;
+    switch (width) {
+    case 2:
+        return ((uint16_t *)ua->data)[i];
+    case 3:
+        p = (uint8_t *)ua->data + 3 * (size_t)i;
+        return p[0] | (p[1] << 8) | ((uint32_t)p[2] << 16);
+    default:
+        return ua->data[i];
+    }
+}
+//}}}
+
+//{{{static inline void sparse_row_set(struct uint32_t_array *ua,
+static inline void sparse_row_set(struct uint32_t_array *ua,
+                                  uint32_t width,
+                                  uint32_t i,
+                                  uint32_t val)
+{
+    uint8_t *p;
+    switch (width) {
+    case 2:
+        ((uint16_t *)ua->data)[i] = val;
+        break;
+    case 3:
+        p = (uint8_t *)ua->data + 3 * (size_t)i;
+        p[0] = val & 0xff;
+        p[1] = (val >> 8) & 0xff;
+        p[2] = (val >> 16) & 0xff;
+        break;
+    default:
+        ua->data[i] = val;
+    }
+}
+//}}}
+
+//{{{static struct uint32_t_array *sparse_row_init(uint32_t size,
+/*
+ * Row with room for size indices of width bytes.
+ */
+static struct uint32_t_array *sparse_row_init(uint32_t size, uint32_t width)
+{
+    struct uint32_t_array *ua =
+            (struct uint32_t_array *) malloc(sizeof(struct uint32_t_array));
+    if (ua == NULL)
+        err(1, "alloc error in sparse_row_init().\n");
+
+    ua->size = MAX(size, 1);
+    ua->data = (uint32_t *)malloc((size_t)ua->size * width);
+    if (ua->data == NULL)
+        err(1, "alloc error in sparse_row_init().\n");
+
+    ua->num = 0;
+    return ua;
+}
+//}}}
+
+//{{{void uint32_t_sparse_matrix_set_width(struct uint32_t_sparse_matrix *m,
+/*
+ * Repack every row of m with indices of width bytes. Each row is shrunk to
+ * its number of indices.
+ */
+void uint32_t_sparse_matrix_set_width(struct uint32_t_sparse_matrix *m,
+                                      uint32_t width)
+{
+    uint32_t i, j;
+    for (i = 0; i < m->size; ++i) {
+        struct uint32_t_array *ua = m->data[i];
+        if (ua == NULL)
+            continue;
+
+        struct uint32_t_array *packed = sparse_row_init(ua->num, width);
+        for (j = 0; j < ua->num; ++j)
+            sparse_row_set(packed, width, j, sparse_row_get(ua, m->width, j));
+        packed->num = ua->num;
+
+        uint32_t_array_destroy(&(m->data[i]));
+        m->data[i] = packed;
+    }
+
+    m->width = width;
+}
+//}}}
+
 //{{{ struct uint32_t_array *uint32_t_sparse_matrix_init(uint32_t rows
 struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_init(uint32_t rows,
                                                            uint32_t cols)
@@ -213,6 +393,8 @@ struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_init(uint32_t rows,
 
     m->size = rows;
     m->rows = 0;
+    m->cols = 0;
+    m->width = 4;
     m->data =  (struct uint32_t_array **)
         malloc(rows * sizeof(struct uint32_t_array *));
 
@@ -271,9 +453,22 @@ uint32_t uint32_t_sparse_matrix_add(struct uint32_t_sparse_matrix *m,
     }
 
     if (m->data[row] == NULL)
-        m->data[row] = uint32_t_array_init(10);
+        m->data[row] = sparse_row_init(10, m->width);
 
-    uint32_t ret = uint32_t_array_add(m->data[row], val);
+    if ((m->width < 4) && (val >> (8 * m->width)))
+        uint32_t_sparse_matrix_set_width(m, (val >> 24) ? 4 : 3);
+
+    struct uint32_t_array *ua = m->data[row];
+    if (ua->num == ua->size) {
+        ua->size = ua->size * 2;
+        ua->data = (uint32_t *)
+                realloc(ua->data, (size_t)ua->size * m->width);
+        if (ua->data == NULL)
+            err(1, "alloc error in uint32_t_sparse_martix_add().\n");
+    }
+
+    sparse_row_set(ua, m->width, ua->num, val);
+    ua->num = ua->num + 1;
 
     return m->size;
 }
@@ -288,8 +483,16 @@ uint32_t *uint32_t_sparse_martix_get(struct uint32_t_sparse_matrix *m,
         err(1,
             "ERROR accessing row %d. "
             "Row is NULL in uint32_t_sparse_martix_get\n", row);
-    else
+
+    if (m->width == 4)
         return uint32_t_array_get(m->data[row], col);
+
+    // Narrower indices are not addressable as uint32_t, so the value is
+    // returned through m->value
+    if (col >= m->data[row]->num)
+        return NULL;
+    m->value = sparse_row_get(m->data[row], m->width, col);
+    return &(m->value);
 }
 //}}}
 
@@ -298,8 +501,16 @@ uint32_t sparse_martix_get(struct uint32_t_sparse_matrix *m,
                                      uint32_t row,
                                      uint32_t col)
 {
-    uint32_t *v = uint32_t_sparse_martix_get(m, row, col);
-    return *v;
+    if ((row > m->rows) || (m->data[row] == NULL))
+        err(1,
+            "ERROR accessing row %d. "
+            "Row is NULL in sparse_martix_get\n", row);
+    if (col >= m->data[row]->num)
+        errx(1,
+             "ERROR accessing column %d of row %d. "
+             "Column is out of range in sparse_martix_get\n", col, row);
+
+    return sparse_row_get(m->data[row], m->width, col);
 }
 //}}}
 
@@ -310,6 +521,13 @@ uint32_t uint32_t_sparse_matrix_write(struct uint32_t_sparse_matrix *m,
 {
     uint32_t written = 0;
 
+    if (m->width != 4) {
+        uint32_t magic[2] = {SPARSE_MATRIX_MAGIC, m->width};
+        if (fwrite(magic, sizeof(uint32_t), 2, fp) != 2)
+            err(1, "Could not write uint32_t_sparse_matrix index width");
+        written += 2;
+    }
+
     if (fwrite(&(m->rows), sizeof(uint32_t), 1, fp) != 1)
         err(1, "Could not write uint32_t_sparse_matrix number of rows");
 
@@ -338,7 +556,7 @@ uint32_t uint32_t_sparse_matrix_write(struct uint32_t_sparse_matrix *m,
     for (i = 0; i < m->rows; ++i) {
         if ((m->data[i] != NULL) && (m->data[i]->num > 0) ){
             if (fwrite(m->data[i]->data,
-                       sizeof(uint32_t),
+                       m->width,
                        m->data[i]->num, fp) != m->data[i]->num)
                 err(1, "Could not write uint32_t_sparse_matrix row data");
             written += m->data[i]->num;
@@ -365,11 +583,24 @@ struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_read(char *file_name)
     uint32_t v;
     size_t fr = fread(&v, sizeof(uint32_t), 1, fp);
     check_file_read(file_name, fp, 1, fr);
+
+    uint32_t file_width = 4;
+    if (v == SPARSE_MATRIX_MAGIC) {
+        fr = fread(&v, sizeof(uint32_t), 1, fp);
+        check_file_read(file_name, fp, 1, fr);
+        if ((v < 2) || (v > 4))
+            errx(1, "Unsupported index width %u in \"%s\"", v, file_name);
+        file_width = v;
+
+        fr = fread(&v, sizeof(uint32_t), 1, fp);
+        check_file_read(file_name, fp, 1, fr);
+    }
     m->size = v;
     m->rows = v;
 
     fr = fread(&v, sizeof(uint32_t), 1, fp);
     m->cols = v;
+    m->width = MIN(file_width, sparse_matrix_width(m->cols));
 
     m->data =  (struct uint32_t_array **)
         malloc(m->rows * sizeof(struct uint32_t_array *));
@@ -379,7 +610,12 @@ struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_read(char *file_name)
     fr = fread(sizes, sizeof(uint32_t), m->rows, fp);
 
 
+    // Rows of files with wider indices than needed are read into wide and
+    // narrowed one at a time
+    struct uint32_t_array *wide = sparse_row_init(1, file_width);
+
     int i;
+    uint32_t j;
     uint32_t last_size = 0;
     for (i = 0; i < m->rows; ++i) {
         uint32_t curr_size = sizes[i] - last_size;
@@ -387,25 +623,31 @@ struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_read(char *file_name)
         if (curr_size == 0) {
             m->data[i] = NULL;
         } else {
-            m->data[i] =
-                    (struct uint32_t_array *)
-                    malloc(sizeof(struct uint32_t_array));
-            if ( m->data[i] == NULL)
-                err(1, "alloc error in uint32_t_sparse_matrix_read().\n");
-
-            m->data[i]->size = curr_size;
-            m->data[i]->data =
-                    (uint32_t *)malloc(curr_size * sizeof(uint32_t));
-            if (m->data[i]->data == NULL)
-                err(1, "alloc error in uint32_t_sparse_matrix_read().\n");
-
-            fr = fread(m->data[i]->data, sizeof(uint32_t), curr_size, fp);
+            m->data[i] = sparse_row_init(curr_size, m->width);
+
+            if (file_width == m->width) {
+                fr = fread(m->data[i]->data, m->width, curr_size, fp);
+            } else {
+                if (curr_size > wide->size) {
+                    wide->size = curr_size;
+                    wide->data = (uint32_t *)
+                            realloc(wide->data, (size_t)curr_size * file_width);
+                    if (wide->data == NULL)
+                        err(1, "alloc error in uint32_t_sparse_matrix_read().\n");
+                }
+                fr = fread(wide->data, file_width, curr_size, fp);
+                for (j = 0; j < curr_size; ++j)
+                    sparse_row_set(m->data[i], m->width, j,
+                                   sparse_row_get(wide, file_width, j));
+            }
+            check_file_read(file_name, fp, curr_size, fr);
             m->data[i]->num = curr_size;
         }
 
         last_size = sizes[i];
     }
 
+    uint32_t_array_destroy(&wide);
     free(sizes);
     fclose(fp);
     return m;
@@ -491,7 +733,48 @@ uint32_t uint32_t_sparse_martix_prune_row(struct uint32_t_sparse_matrix *m,
     qsort(keep_idxs, num_keep, sizeof(uint32_t), uint32_t_compare);
 
     for (i = 0; i < num_keep; ++i) {
-        ua->data[i] = ua->data[keep_idxs[i]];
+        sparse_row_set(ua, m->width, i,
+                       sparse_row_get(ua, m->width, keep_idxs[i]));
+    }
+
+    ua->num = num_keep;
+
+    free(keep_idxs);
+
+    return ua->num;
+}
+//}}}
+
+//{{{uint32_t uint32_t_sparse_martix_prune_row_keyed(
+uint32_t uint32_t_sparse_martix_prune_row_keyed(struct uint32_t_sparse_matrix *m,
+                                                uint32_t row,
+                                                uint32_t num_prune,
+                                                uint32_t seed,
+                                                uint32_t replicate,
+                                                uint32_t purpose)
+{
+    if ((row > m->rows) || (m->data[row] == NULL) || (m->data[row]->num==0 ))
+        return 0;
+
+    struct uint32_t_array *ua = m->data[row];
+    if(num_prune > ua->num)
+      return 0;
+    uint32_t num_keep = ua->num - num_prune;
+
+    uint32_t *keep_idxs = (uint32_t *) malloc( num_keep * sizeof(uint32_t) );
+    reservoir_sample_keyed(ua->num,
+                           num_keep,
+                           keep_idxs,
+                           seed,
+                           replicate,
+                           row,
+                           purpose);
+    uint32_t i;
+    qsort(keep_idxs, num_keep, sizeof(uint32_t), uint32_t_compare);
+
+    for (i = 0; i < num_keep; ++i) {
+        sparse_row_set(ua, m->width, i,
+                       sparse_row_get(ua, m->width, keep_idxs[i]));
     }
 
     ua->num = num_keep;
@@ -502,6 +785,132 @@ uint32_t uint32_t_sparse_martix_prune_row(struct uint32_t_sparse_matrix *m,
 }
 //}}}
 
+//{{{struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_from_sizes(
+/*
+ * Allocate a matrix with room for exactly sizes[i] values in row i, stored
+ * in the narrowest width for cols. Rows with no values are left NULL, as in
+ * uint32_t_sparse_matrix_read.
+ */
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_from_sizes(
+        uint32_t rows,
+        uint32_t cols,
+        uint32_t *sizes)
+{
+    struct uint32_t_sparse_matrix *m =
+            (struct uint32_t_sparse_matrix *)
+            malloc(sizeof(struct uint32_t_sparse_matrix));
+    if (m == NULL)
+        err(1, "malloc error in uint32_t_sparse_matrix_from_sizes().\n");
+
+    m->size = rows;
+    m->rows = rows;
+    m->cols = cols;
+    m->width = sparse_matrix_width(cols);
+    m->data =  (struct uint32_t_array **)
+        malloc(rows * sizeof(struct uint32_t_array *));
+    if (m->data == NULL)
+        err(1, "malloc error in uint32_t_sparse_matrix_from_sizes().\n");
+
+    uint32_t i;
+    for (i = 0; i < rows; ++i) {
+        if (sizes[i] == 0) {
+            m->data[i] = NULL;
+        } else {
+            m->data[i] = sparse_row_init(sizes[i], m->width);
+        }
+    }
+
+    return m;
+}
+//}}}
+
+//{{{struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_transpose(
+/*
+ * Column index of m: row j of the result lists, in order, the rows of m
+ * that have a value in column j.
+ */
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_transpose(
+        struct uint32_t_sparse_matrix *m)
+{
+    uint32_t *sizes = (uint32_t *) calloc(m->cols, sizeof(uint32_t));
+    if (sizes == NULL)
+        err(1, "alloc error in uint32_t_sparse_matrix_transpose().\n");
+
+    uint32_t i, j;
+    for (i = 0; i < m->rows; ++i) {
+        if (m->data[i] == NULL)
+            continue;
+        for (j = 0; j < m->data[i]->num; ++j)
+            sizes[sparse_row_get(m->data[i], m->width, j)] += 1;
+    }
+
+    struct uint32_t_sparse_matrix *t =
+            uint32_t_sparse_matrix_from_sizes(m->cols, m->rows, sizes);
+
+    for (i = 0; i < m->rows; ++i) {
+        if (m->data[i] == NULL)
+            continue;
+        for (j = 0; j < m->data[i]->num; ++j) {
+            struct uint32_t_array *ua =
+                    t->data[sparse_row_get(m->data[i], m->width, j)];
+            sparse_row_set(ua, t->width, ua->num, i);
+            ua->num += 1;
+        }
+    }
+
+    free(sizes);
+    return t;
+}
+//}}}
+
+//{{{struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_subset_cols(
+/*
+ * Row-major matrix of the given columns of the matrix whose column index
+ * is csc. cols must be in increasing order, and column cols[k] becomes
+ * column k of the result. Only the values in the kept columns are visited.
+ */
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_subset_cols(
+        struct uint32_t_sparse_matrix *csc,
+        uint32_t *cols,
+        uint32_t num_cols)
+{
+    uint32_t *sizes = (uint32_t *) calloc(csc->cols, sizeof(uint32_t));
+    if (sizes == NULL)
+        err(1, "alloc error in uint32_t_sparse_matrix_subset_cols().\n");
+
+    uint32_t k, j;
+    for (k = 0; k < num_cols; ++k) {
+        if (cols[k] >= csc->rows)
+            errx(1,
+                 "ERROR column %u is out of range "
+                 "in uint32_t_sparse_matrix_subset_cols\n", cols[k]);
+        struct uint32_t_array *ua = csc->data[cols[k]];
+        if (ua == NULL)
+            continue;
+        for (j = 0; j < ua->num; ++j)
+            sizes[sparse_row_get(ua, csc->width, j)] += 1;
+    }
+
+    struct uint32_t_sparse_matrix *m =
+            uint32_t_sparse_matrix_from_sizes(csc->cols, num_cols, sizes);
+
+    for (k = 0; k < num_cols; ++k) {
+        struct uint32_t_array *ua = csc->data[cols[k]];
+        if (ua == NULL)
+            continue;
+        for (j = 0; j < ua->num; ++j) {
+            struct uint32_t_array *row =
+                    m->data[sparse_row_get(ua, csc->width, j)];
+            sparse_row_set(row, m->width, row->num, k);
+            row->num += 1;
+        }
+    }
+
+    free(sizes);
+    return m;
+}
+//}}}
+
 //{{{struct uint32_t_sparse_matrix *read_matrix(char *file_name)
 struct uint32_t_sparse_matrix *read_matrix(char *file_name)
 {
@@ -551,6 +960,7 @@ struct uint32_t_sparse_matrix *read_uncompressed_matrix(char *file_name)
                                             &row,
                                             &col);
     M->cols = max_col;
+    uint32_t_sparse_matrix_set_width(M, sparse_matrix_width(M->cols));
 
     free(buffer);
 
@@ -610,6 +1020,7 @@ struct uint32_t_sparse_matrix *read_compressed_matrix(char *file_name)
     free(buffer);
 
     M->cols = max_col;
+    uint32_t_sparse_matrix_set_width(M, sparse_matrix_width(M->cols));
 
     return M;
 }
@@ -8,6 +8,23 @@ void reservoir_sample(uint32_t max, uint32_t N, uint32_t *R);
 int uint32_t_compare( const void* a , const void* b );
 double rand_double(void);
 
+// COUNTER-BASED RANDOM STREAMS
+// Draws are keyed by (seed, replicate) and addressed by (row, purpose,
+// counter), so any row's draws can be reproduced on their own.
+void philox4x32_10(uint32_t ctr[4], uint32_t key[2], uint32_t out[4]);
+double philox_uniform(uint32_t seed,
+                      uint32_t replicate,
+                      uint32_t row,
+                      uint32_t purpose,
+                      uint32_t counter);
+void reservoir_sample_keyed(uint32_t max,
+                            uint32_t N,
+                            uint32_t *R,
+                            uint32_t seed,
+                            uint32_t replicate,
+                            uint32_t row,
+                            uint32_t purpose);
+
 // UINT32 ARRAY
 struct uint32_t_array
 {
@@ -26,13 +43,27 @@ uint32_t uint32_t_array_write(struct uint32_t_array *ua, char *file_name);
 struct uint32_t_array *uint32_t_array_read(char *file_name);
 
 // UINT32 SPARSE MATRIX
+// Column indices are stored in width bytes (2, 3 or 4), the narrowest that
+// holds every index. Matrices built with uint32_t_sparse_matrix_add start at
+// 4 bytes and widen as needed; matrices read from hap files are narrowed
+// once the number of columns is known. value holds the last index returned
+// by uint32_t_sparse_martix_get from a row narrower than 4 bytes.
 struct uint32_t_sparse_matrix
 {
-    uint32_t rows, size, cols;
+    uint32_t rows, size, cols, width, value;
     struct uint32_t_array **data;
 
 };
 
+// .sm files of matrices narrower than 4 bytes start with this word and the
+// width, followed by the 4 byte layout with each index in width bytes
+#define SPARSE_MATRIX_MAGIC 0xFFFFFFFF
+
+uint32_t sparse_matrix_width(uint32_t cols);
+
+void uint32_t_sparse_matrix_set_width(struct uint32_t_sparse_matrix *m,
+                                      uint32_t width);
+
 struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_init(uint32_t rows,
                                                            uint32_t cols);
 
@@ -70,6 +101,26 @@ uint32_t uint32_t_sparse_martix_prune_row(struct uint32_t_sparse_matrix *m,
                                           uint32_t row,
                                           uint32_t num_prune);
 
+uint32_t uint32_t_sparse_martix_prune_row_keyed(struct uint32_t_sparse_matrix *m,
+                                                uint32_t row,
+                                                uint32_t num_prune,
+                                                uint32_t seed,
+                                                uint32_t replicate,
+                                                uint32_t purpose);
+
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_from_sizes(
+        uint32_t rows,
+        uint32_t cols,
+        uint32_t *sizes);
+
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_transpose(
+        struct uint32_t_sparse_matrix *m);
+
+struct uint32_t_sparse_matrix *uint32_t_sparse_matrix_subset_cols(
+        struct uint32_t_sparse_matrix *csc,
+        uint32_t *cols,
+        uint32_t num_cols);
+
 struct uint32_t_sparse_matrix *read_matrix(char *file_name);
 struct uint32_t_sparse_matrix *read_compressed_matrix(char *file_name);
 struct uint32_t_sparse_matrix *read_uncompressed_matrix(char *file_name);
@@ -27,6 +27,53 @@ void test_sampling(void)
 }
 //}}}
 
+//{{{void test_philox(void)
+void test_philox(void)
+{
+    // Known answers from the Random123 philox4x32_10 test vectors
+    uint32_t ctr[4] = {0, 0, 0, 0};
+    uint32_t key[2] = {0, 0};
+    uint32_t out[4];
+    philox4x32_10(ctr, key, out);
+    TEST_ASSERT_EQUAL_HEX32(0x6627e8d5, out[0]);
+    TEST_ASSERT_EQUAL_HEX32(0xe169c58d, out[1]);
+    TEST_ASSERT_EQUAL_HEX32(0xbc57ac4c, out[2]);
+    TEST_ASSERT_EQUAL_HEX32(0x9b00dbd8, out[3]);
+
+    uint32_t ctr_pi[4] = {0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344};
+    uint32_t key_pi[2] = {0xa4093822, 0x299f31d0};
+    philox4x32_10(ctr_pi, key_pi, out);
+    TEST_ASSERT_EQUAL_HEX32(0xd16cfe09, out[0]);
+    TEST_ASSERT_EQUAL_HEX32(0x94fdcceb, out[1]);
+    TEST_ASSERT_EQUAL_HEX32(0x5001e420, out[2]);
+    TEST_ASSERT_EQUAL_HEX32(0x24126ea1, out[3]);
+
+    double u = philox_uniform(123, 0, 5, 0, 0);
+    TEST_ASSERT_TRUE(u >= 0 && u < 1);
+    TEST_ASSERT_TRUE(u == philox_uniform(123, 0, 5, 0, 0));
+    TEST_ASSERT_TRUE(u != philox_uniform(123, 1, 5, 0, 0));
+    TEST_ASSERT_TRUE(u != philox_uniform(123, 0, 6, 0, 0));
+}
+//}}}
+
+//{{{void test_sampling_keyed(void)
+void test_sampling_keyed(void)
+{
+    uint32_t *R = (uint32_t *) malloc(10 * sizeof(uint32_t));
+    uint32_t *S = (uint32_t *) malloc(10 * sizeof(uint32_t));
+    reservoir_sample_keyed(100, 10, R, 123, 0, 7, 3);
+    reservoir_sample_keyed(100, 10, S, 123, 0, 7, 3);
+
+    uint32_t i;
+    for (i = 0; i < 10; i++) {
+        TEST_ASSERT_TRUE(R[i] < 100);
+        TEST_ASSERT_EQUAL(R[i], S[i]);
+    }
+    free(R);
+    free(S);
+}
+//}}}
+
 //{{{void test_uint32_t_array(void)
 void test_uint32_t_array(void)
 {
@@ -92,6 +139,96 @@ void test_uint32_t_array(void)
 }
 //}}}
 
+//{{{void test_uint32_t_sparse_matrix_transpose(void)
+void test_uint32_t_sparse_matrix_transpose(void)
+{
+    struct uint32_t_sparse_matrix *m = uint32_t_sparse_matrix_init(10, 10);
+    char *buffer = "1 0 1 0\n0 0 0 0\n0 1 1 0\n";
+    uint32_t row = 0, col = 0;
+    m->cols = add_buffer_to_matrix(buffer, strlen(buffer), m, &row, &col);
+
+    struct uint32_t_sparse_matrix *t = uint32_t_sparse_matrix_transpose(m);
+    TEST_ASSERT_EQUAL(4, t->rows);
+    TEST_ASSERT_EQUAL(3, t->cols);
+    TEST_ASSERT_EQUAL(1, uint32_t_sparse_martix_row_num(t, 0));
+    TEST_ASSERT_EQUAL(0, sparse_martix_get(t, 0, 0));
+    TEST_ASSERT_EQUAL(2, uint32_t_sparse_martix_row_num(t, 2));
+    TEST_ASSERT_EQUAL(0, sparse_martix_get(t, 2, 0));
+    TEST_ASSERT_EQUAL(2, sparse_martix_get(t, 2, 1));
+    TEST_ASSERT_EQUAL(0, uint32_t_sparse_martix_row_num(t, 3));
+
+    uint32_t cols[2] = {1, 2};
+    struct uint32_t_sparse_matrix *s =
+            uint32_t_sparse_matrix_subset_cols(t, cols, 2);
+    TEST_ASSERT_EQUAL(3, s->rows);
+    TEST_ASSERT_EQUAL(2, s->cols);
+    TEST_ASSERT_EQUAL(1, uint32_t_sparse_martix_row_num(s, 0));
+    TEST_ASSERT_EQUAL(1, sparse_martix_get(s, 0, 0));
+    TEST_ASSERT_EQUAL(0, uint32_t_sparse_martix_row_num(s, 1));
+    TEST_ASSERT_EQUAL(2, uint32_t_sparse_martix_row_num(s, 2));
+    TEST_ASSERT_EQUAL(0, sparse_martix_get(s, 2, 0));
+    TEST_ASSERT_EQUAL(1, sparse_martix_get(s, 2, 1));
+
+    uint32_t_sparse_matrix_destroy(&m);
+    uint32_t_sparse_matrix_destroy(&t);
+    uint32_t_sparse_matrix_destroy(&s);
+}
+//}}}
+
+//{{{void test_uint32_t_sparse_matrix_width(void)
+void test_uint32_t_sparse_matrix_width(void)
+{
+    TEST_ASSERT_EQUAL(2, sparse_matrix_width(20));
+    TEST_ASSERT_EQUAL(2, sparse_matrix_width(65536));
+    TEST_ASSERT_EQUAL(3, sparse_matrix_width(65537));
+    TEST_ASSERT_EQUAL(4, sparse_matrix_width(16777217));
+
+    struct uint32_t_sparse_matrix *m = uint32_t_sparse_matrix_init(10, 10);
+    char *buffer = "1 0 1 0 1\n0 0 0 0 0\n0 1 1 0 0\n";
+    uint32_t row = 0, col = 0;
+    m->cols = add_buffer_to_matrix(buffer, strlen(buffer), m, &row, &col);
+    TEST_ASSERT_EQUAL(4, m->width);
+
+    uint32_t_sparse_matrix_set_width(m, sparse_matrix_width(m->cols));
+    TEST_ASSERT_EQUAL(2, m->width);
+    TEST_ASSERT_EQUAL(3, uint32_t_sparse_martix_row_num(m, 0));
+    TEST_ASSERT_EQUAL(4, sparse_martix_get(m, 0, 2));
+    TEST_ASSERT_EQUAL(2, *uint32_t_sparse_martix_get(m, 2, 1));
+    TEST_ASSERT_NULL(uint32_t_sparse_martix_get(m, 2, 2));
+
+    // Adding an index that does not fit widens the matrix
+    uint32_t_sparse_matrix_add(m, 2, 70000);
+    m->cols = 70001;
+    TEST_ASSERT_EQUAL(3, m->width);
+    TEST_ASSERT_EQUAL(3, uint32_t_sparse_martix_row_num(m, 2));
+    TEST_ASSERT_EQUAL(1, sparse_martix_get(m, 2, 0));
+    TEST_ASSERT_EQUAL(70000, sparse_martix_get(m, 2, 2));
+
+    write_matrix(m, "test_width_file.dat");
+    struct uint32_t_sparse_matrix *m1 =
+            uint32_t_sparse_matrix_read("test_width_file.dat");
+    TEST_ASSERT_EQUAL(3, m1->width);
+    TEST_ASSERT_EQUAL(m->rows, m1->rows);
+    TEST_ASSERT_EQUAL(m->cols, m1->cols);
+    uint32_t i, j;
+    for (i = 0; i < m->rows; ++i) {
+        TEST_ASSERT_EQUAL(uint32_t_sparse_martix_row_num(m, i),
+                          uint32_t_sparse_martix_row_num(m1, i));
+        for (j = 0; j < uint32_t_sparse_martix_row_num(m, i); ++j)
+            TEST_ASSERT_EQUAL(sparse_martix_get(m, i, j),
+                              sparse_martix_get(m1, i, j));
+    }
+
+    // Pruning keeps the remaining indices in order
+    TEST_ASSERT_EQUAL(2, uint32_t_sparse_martix_prune_row(m1, 2, 1));
+    TEST_ASSERT_TRUE(sparse_martix_get(m1, 2, 0) <
+                     sparse_martix_get(m1, 2, 1));
+
+    uint32_t_sparse_matrix_destroy(&m);
+    uint32_t_sparse_matrix_destroy(&m1);
+}
+//}}}
+
 //{{{void test_uint32_t_sparse_matrix(void)
 void test_uint32_t_sparse_matrix(void)
 {
@@ -0,0 +1,90 @@
+from rareSim import sparse
+import sys
+import argparse
+from header import *
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m',
+                        dest='sparse_matrix',
+                        required=True,
+                        help='Input sparse matrix path')
+
+    parser.add_argument('-p',
+                        dest='plan',
+                        required=True,
+                        help='Input pruning plan')
+
+    parser.add_argument('-l',
+                        dest='input_legend',
+                        help='Input variant site legend')
+
+    parser.add_argument('-L',
+                        dest='output_legend',
+                        help='Output variant site legend')
+
+    parser.add_argument('-H',
+                        dest='output_hap',
+                        help='Output compress hap file')
+
+    parser.add_argument('--start',
+                        dest='start',
+                        type=int,
+                        default=0,
+                        help='First input row to materialize')
+
+    parser.add_argument('--end',
+                        dest='end',
+                        type=int,
+                        help='Input row to stop materializing at (exclusive)')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue a partially written hap file')
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+    args = get_args()
+
+    if args.output_hap is None and args.output_legend is None:
+        sys.exit("Nothing to materialize. Provide -H and/or -l and -L")
+    if args.output_legend is not None and args.input_legend is None:
+        sys.exit("Input legend file not provided")
+
+    meta, all_kept_rows, selections = read_plan(args.plan)
+
+    end = args.end if args.end is not None else int(meta['rows'])
+    all_kept_rows = [row_i for row_i in all_kept_rows
+                     if row_i >= args.start and row_i < end]
+
+    if args.output_legend is not None:
+        print('Writing new variant legend')
+        write_legend(all_kept_rows, args.input_legend, args.output_legend,
+                     args.start)
+
+    if args.output_hap is not None:
+        M = sparse(None)
+        M.load(args.sparse_matrix)
+        try:
+            verify_plan(meta, M, matrix_checksum(args.sparse_matrix))
+        except Error as e:
+            sys.exit(str(e))
+
+        # A partial hap file is only resumed for the same plan and rows
+        print('Writing new haplotype file', end='', flush=True)
+        try:
+            write_hap(all_kept_rows, args.output_hap, M, selections, args.resume,
+                      meta={'plan': file_checksum(args.plan),
+                            'seed': meta['seed'],
+                            'start': args.start,
+                            'end': end})
+        except Error as e:
+            print()
+            sys.exit(str(e))
+
+if __name__ == '__main__': main()
@@ -1,5 +1,6 @@
 cimport rsdec
 from libc.stdint cimport uintptr_t, uint32_t
+from libc.stdlib cimport malloc, free, qsort
 from libcpp cimport str
 
 cdef class arrays:
@@ -37,6 +38,10 @@ cdef class sparse:
             self.path = p
             self.sparse32 = rsdec.read_matrix(to_bytes(p))
 
+    def __dealloc__(self):
+        if self.sparse32 != NULL:
+            rsdec.uint32_t_sparse_matrix_destroy(&self.sparse32)
+
     def add(self, row, val)-> int:
         return rsdec.uint32_t_sparse_matrix_add( self.sparse32, row, val)
     def get(self, row, col) -> uint32_t:
@@ -44,12 +49,17 @@ cdef class sparse:
 
     def load(self, path):
         #cdef char* c_filename = byte_filename
+        if self.sparse32 != NULL:
+            rsdec.uint32_t_sparse_matrix_destroy(&self.sparse32)
         self.sparse32= rsdec.uint32_t_sparse_matrix_read(to_bytes(path))
 
     def remove_row(self, row)->void:
         rsdec.uint32_t_sparse_martix_remove_row( self.sparse32,  row);
     def prune_row(self , row, num_prune) -> int:
         return rsdec.uint32_t_sparse_martix_prune_row( self.sparse32, row, num_prune)
+    def prune_row_keyed(self, row, num_prune, seed, replicate, purpose) -> int:
+        return rsdec.uint32_t_sparse_martix_prune_row_keyed( self.sparse32, row, num_prune,
+                                                             seed, replicate, purpose)
 
     def num_rows(self)-> int:
         return rsdec.uint32_t_sparse_martix_num_rows(self.sparse32)
@@ -59,11 +69,51 @@ cdef class sparse:
         return rsdec.uint32_t_sparse_martix_not_Null(self.sparse32, row)
     def row_num(self, row)->int:
         return rsdec.uint32_t_sparse_martix_row_num(self.sparse32, row)
+    def width(self)->int:
+        # Bytes per stored column index
+        return self.sparse32.width
+    def nbytes(self)->int:
+        # Approximate memory held by the matrix
+        cdef size_t total = self.sparse32.size * sizeof(void *)
+        cdef uint32_t i
+        for i in range(self.sparse32.size):
+            if self.sparse32.data[i] != NULL:
+                total += sizeof(rsdec.uint32_t_array) + \
+                         self.sparse32.data[i].size * self.sparse32.width
+        return total
+    def row(self, row):
+        return [rsdec.sparse_martix_get( self.sparse32, row, i)
+                for i in range(self.row_num(row))]
+    def transpose(self):
+        cdef sparse T = sparse(None)
+        T.sparse32 = rsdec.uint32_t_sparse_matrix_transpose(self.sparse32)
+        return T
+    def subset_cols(self, cols):
+        # Called on a column index (see transpose); cols must be increasing
+        cdef uint32_t num_cols = len(cols)
+        cdef uint32_t *c_cols = <uint32_t *> malloc(num_cols * sizeof(uint32_t))
+        for i in range(num_cols):
+            c_cols[i] = cols[i]
+        cdef sparse S = sparse(None)
+        S.sparse32 = rsdec.uint32_t_sparse_matrix_subset_cols(self.sparse32, c_cols, num_cols)
+        free(c_cols)
+        return S
     def write(self, outfile) -> void:
         byte_file_name = outfile.encode('UTF-8')
         cdef char* c_filename = byte_file_name
         rsdec.write_matrix( self.sparse32,c_filename)
 
+def philox_uniform(seed, replicate, row, purpose, counter=0) -> float:
+    return rsdec.philox_uniform(seed, replicate, row, purpose, counter)
+
+def keyed_sample(n, k, seed, replicate, row, purpose):
+    cdef uint32_t *R = <uint32_t *> malloc(k * sizeof(uint32_t))
+    rsdec.reservoir_sample_keyed(n, k, R, seed, replicate, row, purpose)
+    qsort(R, k, sizeof(uint32_t), rsdec.uint32_t_compare)
+    sample = [R[i] for i in range(k)]
+    free(R)
+    return sample
+
 cdef to_bytes(s, enc='UTF-8'):
     if not isinstance(s, bytes):
         return s.encode(enc)
@@ -22,10 +22,28 @@ cdef extern from "lib/raresim/src/lists.h":
     uint32_t uint32_t_array_write(uint32_t_array *ua, char *file_name)
     uint32_t_array *uint32_t_array_read(char *file_name)
 
+    #// COUNTER-BASED RANDOM STREAMS
+
+    double philox_uniform(uint32_t seed,
+                          uint32_t replicate,
+                          uint32_t row,
+                          uint32_t purpose,
+                          uint32_t counter)
+
+    void reservoir_sample_keyed(uint32_t max,
+                                uint32_t N,
+                                uint32_t *R,
+                                uint32_t seed,
+                                uint32_t replicate,
+                                uint32_t row,
+                                uint32_t purpose)
+
+    int uint32_t_compare(const void *a, const void *b) nogil
+
     #// UINT32 SPARSE MATRIX |||
 
     cdef struct uint32_t_sparse_matrix:
-        uint32_t rows, size
+        uint32_t rows, size, cols, width
         uint32_t_array **data
 
     uint32_t_sparse_matrix *uint32_t_sparse_matrix_init(uint32_t rows,
@@ -64,6 +82,19 @@ cdef extern from "lib/raresim/src/lists.h":
                                               uint32_t row,
                                               uint32_t num_prune)
 
+    uint32_t uint32_t_sparse_martix_prune_row_keyed(uint32_t_sparse_matrix *m,
+                                                    uint32_t row,
+                                                    uint32_t num_prune,
+                                                    uint32_t seed,
+                                                    uint32_t replicate,
+                                                    uint32_t purpose)
+
+    uint32_t_sparse_matrix *uint32_t_sparse_matrix_transpose(uint32_t_sparse_matrix *m)
+
+    uint32_t_sparse_matrix *uint32_t_sparse_matrix_subset_cols(uint32_t_sparse_matrix *csc,
+                                                               uint32_t *cols,
+                                                               uint32_t num_cols)
+
     uint32_t_sparse_matrix *read_matrix(char *file_name)
 
     void write_matrix(uint32_t_sparse_matrix *m, char *file_name)
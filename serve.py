@@ -0,0 +1,174 @@
+import argparse
+import io
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from header import LRUCache, get_args as get_sim_args
+from sim import simulate
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--host',
+                        dest='host',
+                        default='127.0.0.1',
+                        help='Address to listen on')
+
+    parser.add_argument('--port',
+                        dest='port',
+                        type=int,
+                        default=8765,
+                        help='Port to listen on')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help='Number of simulations to run at the same time, as threads that share the cache and do not prune in parallel')
+
+    parser.add_argument('--cache_mb',
+                        dest='cache_mb',
+                        type=int,
+                        default=4096,
+                        help='Memory budget in MB for cached matrices, legends and bin assignments')
+
+    args = parser.parse_args()
+
+    return args
+
+
+class ThreadOutput:
+    """Stand-in for sys.stdout and sys.stderr that sends the output of a
+    thread to its own buffer while capture is on, so the log of each
+    simulation can be returned with its result."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, s):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stream if buffer is None else buffer).write(s)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+
+class SimulationService:
+    """Runs simulate requests on a pool of workers, sharing one cache of
+    loaded inputs."""
+
+    def __init__(self, workers, cache):
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.counts = {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0}
+        sys.stdout = self.stdout = ThreadOutput(sys.stdout)
+        sys.stderr = self.stderr = ThreadOutput(sys.stderr)
+
+    def count(self, frm, to):
+        with self.lock:
+            if frm is not None:
+                self.counts[frm] -= 1
+            self.counts[to] += 1
+
+    def run(self, argv):
+        self.count('queued', 'running')
+        log = io.StringIO()
+        self.stdout.capture(log)
+        self.stderr.capture(log)
+        try:
+            args = get_sim_args(argv)
+            simulate(args, self.cache)
+        except SystemExit as e:
+            # Input errors end simulate (and argparse) with sys.exit
+            self.count('running', 'failed')
+            error = e.code if isinstance(e.code, str) else f'exit status {e.code}'
+            return {'status': 'error', 'error': error, 'log': log.getvalue()}
+        except Exception as e:
+            self.count('running', 'failed')
+            return {'status': 'error', 'error': str(e), 'log': log.getvalue()}
+        finally:
+            self.stdout.capture(None)
+            self.stderr.capture(None)
+
+        self.count('running', 'completed')
+        outputs = {'legend': args.output_legend,
+                   'hap': args.output_hap,
+                   'plan': args.plan_only if args.plan_only is not None else args.plan,
+                   'state': args.state}
+        return {'status': 'ok',
+                'outputs': {k: v for k, v in outputs.items() if v is not None},
+                'log': log.getvalue()}
+
+    def simulate(self, argv):
+        """Queue a simulation with the sim.py arguments argv and wait for
+        its result"""
+        self.count(None, 'queued')
+        return self.pool.submit(self.run, argv).result()
+
+    def metrics(self):
+        with self.lock:
+            requests = dict(self.counts)
+        return {'cache': self.cache.metrics(), 'requests': requests}
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.service.metrics())
+        else:
+            self.send_json(404, {'status': 'error', 'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/simulate':
+            self.send_json(404, {'status': 'error', 'error': 'Not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            argv = json.loads(self.rfile.read(length))['args']
+            if not all(isinstance(a, str) for a in argv):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'status': 'error',
+                                 'error': 'Body must be {"args": [<sim.py arguments>]}'})
+            return
+
+        result = self.service.simulate(argv)
+        self.send_json(200 if result['status'] == 'ok' else 422, result)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f'{self.address_string()} - {format % args}\n')
+
+
+def main():
+    args = get_args()
+    Handler.service = SimulationService(args.workers,
+                                        LRUCache(args.cache_mb * 1024 * 1024))
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f'Serving simulations on http://{args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__': main()
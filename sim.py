@@ -1,19 +1,119 @@
 from rareSim import sparse
+import copy
 import gzip
 import sys
 from header import *
 
 
-def main():
-    args = get_args()
-    legend_header, legend = read_legend(args.input_legend)
+def get_strata(args, func_split, fun_only, syn_only):
+    """Legend column, stratum values, stratum headings and bins of the run.
+    The fun/syn options are strata of the fun column, headed as in the
+    legacy output, and unsplit bins are a single stratum of all rows."""
+    if args.stratify is not None:
+        if args.strata_bins is None:
+            raise Exception("If variants are split by --stratify, files must be " + \
+                            "provided for --strata_bins")
+        categories, bins = read_strata_bins(args.strata_bins)
+        return args.stratify, categories, categories, bins
+
+    bins = get_expected_bins(args, func_split, fun_only, syn_only)
+    if func_split:
+        return 'fun', ['fun', 'syn'], ['Functional', 'Synonymous'], \
+                [bins['fun'], bins['syn']]
+    elif fun_only:
+        return 'fun', ['fun'], ['Functional'], [bins]
+    elif syn_only:
+        return 'fun', ['syn'], ['Synonymous'], [bins]
+    return None, [None], [None], [bins]
+
+
+def prune_stratified(args, M, legend, streams, column, categories, labels,
+                     bins, previous=None, cache=None):
+    """Bin and prune the strata. With --state, the results of the previous
+    run are reused where possible and the new state is returned as well."""
+    if previous is not None:
+        strata_h = copy.deepcopy(previous['initial'])
+        other_rows = previous['other_rows']
+    else:
+        strata_h, other_rows = load_strata(M, bins, legend, column,
+                                           categories, args.z,
+                                           (args.sparse_matrix, args.input_legend),
+                                           cache)
+    initial = copy.deepcopy(strata_h)
+
+    print('Input allele frequency distribution:')
+    print_strata_distribution(bins, strata_h, labels)
+
+    try:
+        if args.state is None:
+            R = prune_strata(strata_h, bins, M, streams, args.exact,
+                             args.processes)
+        else:
+            R, results = prune_strata_cached(
+                    strata_h, bins, M, streams, args.exact, args.processes,
+                    None if previous is None else \
+                            list(zip(previous['bins'], previous['results'])))
+    except Exception as e:
+        sys.exit(str(e))
+
+    print()
+    print('New allele frequency distribution:')
+    print_strata_distribution(bins, strata_h, labels)
+
+    all_kept_rows = get_strata_kept_rows(strata_h, R, other_rows, args.z,
+                                         args.keep_protected, legend)
+    if args.state is None:
+        return all_kept_rows, None
+
+    recomputed = sum(result['recomputed']
+                     for stratum in results for result in stratum.values())
+    print()
+    print(f'Recomputed {recomputed} of {sum(len(b) for b in bins)} bins')
+
+    return all_kept_rows, {'initial': initial,
+                           'other_rows': other_rows,
+                           'bins': bins,
+                           'results': results}
+
+
+def simulate(args, cache=None):
+    """Run the simulation described by args (see get_args). Inputs are
+    loaded through cache if given. Every run is binned and pruned with the
+    strata engine, the fun/syn options and unsplit bins as strata of their
+    own (see get_strata)."""
+    legend_header, legend = load_legend(args.input_legend, cache)
     try:
         func_split, fun_only, syn_only = get_split(args)
     except Exception as e:
         sys.exit(str(e))
 
-    M = sparse(None)
-    M.load(args.sparse_matrix)
+    if args.plan_only is not None:
+        if args.prob:
+            sys.exit("-prob can not be used with --plan-only")
+    elif args.output_hap is None:
+        sys.exit("Output hap file not provided")
+
+    state = None
+    if args.state is not None:
+        if args.prob:
+            sys.exit("-prob can not be used with --state")
+        if os.path.exists(args.state):
+            state = read_state(args.state)
+
+    seed = args.seed
+    if seed is None and state is not None:
+        seed = state['config']['seed']
+    if seed is None:
+        seed = random.randrange(2**32)
+        print(f'Seed: {seed} (rerun with --seed {seed} to reproduce this run)')
+        print()
+    if seed < 0 or seed >= 2**32 or args.replicate < 0 or args.replicate >= 2**32:
+        sys.exit("Seed and replicate must be between 0 and 2^32 - 1")
+    streams = RowStreams(seed, args.replicate)
+
+    # Binning and pruning only need the row sizes. The full matrix is loaded
+    # once the rows to write are known.
+    M = load_row_sizes(args.sparse_matrix, streams, cache)
 
     if M.num_cols() < 10000 and not args.small_sample:
         sys.exit("Sample sizes less than 10,000 haplotypes not supported." + \
@@ -22,12 +122,12 @@ def main():
                  "is to oversimulate the number of haplotypes and randomly down-sample to the desired sample size.")
 
     try:
-        verify_legend(legend, legend_header, M, func_split, args.prob)
+        verify_legend(legend, legend_header, M, func_split, args.prob, args.stratify)
     except Exception as e:
         print(f"WARN: {str(e)}")
-    
 
     if args.prob:
+        M = load_sparse(args.sparse_matrix, cache)
         all_rows = []
         for row in range(M.num_rows()):
             all_rows.append(row)
@@ -39,7 +139,7 @@ def main():
                     
                     row = []
                     for col_i in range(M.row_num(row_i)):
-                        flip = random.uniform(0, 1)
+                        flip = streams.uniform(row_i, STREAM_PROB, col_i)
                         if legend[row_i]['prob'] == '.':
                             row.append(M.get(row_i, col_i))
                         elif flip > float(legend[row_i]['prob']):
@@ -59,42 +159,92 @@ def main():
 
     else:
 
-        if args.input_legend is None or args.output_legend is None:
+        if args.input_legend is None or \
+                (args.output_legend is None and args.plan_only is None):
             sys.exit("Legend files not provided")
 
-        bins = get_expected_bins(args, func_split, fun_only, syn_only)
-
-        bin_h = assign_bins(M, bins, legend, func_split, fun_only, syn_only, args.z)
-        print('Input allele frequency distribution:')
-        print_frequency_distribution(bins, bin_h, func_split, fun_only, syn_only)
-        R = []
-
         try:
-            if func_split:
-                R = {'fun':[], 'syn':[]}
-                prune_bins(bin_h['fun'], bins['fun'], R['fun'], M)
-                prune_bins(bin_h['syn'], bins['syn'], R['syn'], M)
-            elif fun_only:
-                prune_bins(bin_h['fun'], bins, R, M)
-            elif syn_only:
-                prune_bins(bin_h['syn'], bins, R, M)
-            else:
-                prune_bins(bin_h, bins, R, M)
+            column, categories, labels, bins = get_strata(args, func_split,
+                                                          fun_only, syn_only)
         except Exception as e:
             sys.exit(str(e))
 
-        print()
-        print('New allele frequency distribution:')
-        print_frequency_distribution(bins, bin_h, func_split, fun_only, syn_only)
-
-        all_kept_rows = get_all_kept_rows(bin_h, R, func_split, fun_only, syn_only, args.z, args.keep_protected, legend)
+        previous = None
+        if args.state is not None:
+            config = {'sparse_matrix': matrix_checksum(args.sparse_matrix),
+                      'sparse_matrix_mtime': os.stat(args.sparse_matrix).st_mtime_ns,
+                      'legend': file_checksum(args.input_legend),
+                      'seed': seed,
+                      'replicate': args.replicate,
+                      'exact': args.exact,
+                      'z': args.z,
+                      'keep_protected': args.keep_protected,
+                      'column': column,
+                      'categories': categories,
+                      'bounds': [[[lower, upper] for lower, upper, need in b]
+                                 for b in bins]}
+            if state is not None and state['config'] == config:
+                previous = state
+            elif state is not None:
+                print('State does not match this run, simulating from scratch')
+
+        all_kept_rows, new_state = prune_stratified(
+                args, M, legend, streams, column, categories, labels, bins,
+                previous, cache)
+        if new_state is not None:
+            new_state.update(config=config,
+                             kept_rows=all_kept_rows,
+                             selections=M.selections,
+                             hap=None,
+                             blocks={})
+
+        plan_file = args.plan_only if args.plan_only is not None else args.plan
+        if plan_file is not None:
+            print()
+            print('Writing pruning plan')
+            write_plan(all_kept_rows, plan_file, M,
+                       matrix_checksum(args.sparse_matrix), seed, args.replicate)
+        if args.plan_only is not None:
+            if new_state is not None:
+                write_state(args.state, new_state)
+            return
         
         print()
         print('Writing new variant legend')
         write_legend(all_kept_rows, args.input_legend, args.output_legend)    
 
+        # Only the blocks of the hap file whose rows changed since the
+        # previous run, or that no longer match the previous hap file, are
+        # rewritten
+        reuse = None
+        if previous is not None and previous['hap'] is not None \
+                and os.path.exists(previous['hap']):
+            verified = verified_blocks(previous['hap'], previous['blocks'])
+            reuse = (previous['hap'],
+                     verified,
+                     changed_blocks(all_kept_rows, M.selections,
+                                    previous['kept_rows'],
+                                    previous['selections']) | \
+                             (set(previous['blocks']) - set(verified)))
+
+        selections = M.selections
+        if reuse is None or reuse[2]:
+            M = load_sparse(args.sparse_matrix, cache)
+
         print()
         print('Writing new haplotype file', end='', flush=True)
-        write_hap(all_kept_rows, args.output_hap, M)
+        # With --state, the hap file is written to a temporary file first so
+        # an interrupted run leaves the previous hap file and state intact
+        hap_file = args.output_hap if new_state is None \
+                else f'{args.output_hap}.tmp'
+        blocks = write_hap(all_kept_rows, hap_file, M, selections,
+                           reuse=reuse)
+        if new_state is not None:
+            os.replace(hap_file, args.output_hap)
+            new_state.update(hap=args.output_hap, blocks=blocks)
+            write_state(args.state, new_state)
+
+def main():
+    simulate(get_args())
 
 if __name__ == '__main__': main()
\ No newline at end of file
@@ -1,6 +1,11 @@
 import unittest
+import copy
+import gzip
+import os
+import tempfile
 from rareSim import sparse
 from header import *
+import header
 import random
 
 class testRaresim(unittest.TestCase):
@@ -60,6 +65,365 @@ class testRaresim(unittest.TestCase):
         true_kept_rows = [0, 4, 5, 8, 9, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 23, 25, 27, 28, 29, 30]
         self.assertEqual(all_kept_rows, true_kept_rows)
 
+    def test_prune_bins_exact(self):
+        legend_header, legend = read_legend('./testData/test.legend')
+        bins = read_expected('./testData/testBins.txt')
+        random.seed(123)
+        M = RowSizes('./testData/test.haps.sm')
+        bin_h = assign_bins(M, bins, legend, False, False, False, False)
+        R = []
+        prune_bins_exact(bin_h, bins, R, M)
+        self.assertEqual([len(bin_h[bin_id]) for bin_id in range(3)], [15, 8, 2])
+        self.assertEqual(len(R), 4)
+
+        # Bin 1 gives up 6 rows, which are all promoted into bin 0
+        bins = [(1, 1, 25), (2, 2, 2), (3, 5, 2)]
+        M = RowSizes('./testData/test.haps.sm')
+        bin_h = assign_bins(M, bins, legend, False, False, False, False)
+        R = []
+        prune_bins_exact(bin_h, bins, R, M)
+        self.assertEqual([len(bin_h[bin_id]) for bin_id in range(3)], [25, 2, 2])
+        self.assertEqual(R, [])
+        for row_id in bin_h[0]:
+            self.assertEqual(M.row_num(row_id), 1)
+
+        bins = [(1, 1, 40), (2, 2, 8), (3, 5, 2)]
+        bin_h = assign_bins(M, bins, legend, False, False, False, False)
+        with self.assertRaises(Exception):
+            prune_bins_exact(bin_h, bins, [], M)
+
+    def test_row_streams(self):
+        streams = RowStreams(123, 1)
+        self.assertEqual(streams.uniform(5, STREAM_REMOVE), RowStreams(123, 1).uniform(5, STREAM_REMOVE))
+        self.assertNotEqual(streams.uniform(5, STREAM_REMOVE), streams.uniform(6, STREAM_REMOVE))
+        self.assertNotEqual(streams.uniform(5, STREAM_REMOVE), streams.uniform(5, STREAM_ADD))
+        self.assertNotEqual(streams.uniform(5, STREAM_REMOVE), RowStreams(123, 2).uniform(5, STREAM_REMOVE))
+
+        rows = list(range(100))
+        sample = streams.sample_rows(rows, 10, STREAM_REMOVE)
+        self.assertEqual(len(set(sample)), 10)
+        self.assertEqual(sorted(sample), sorted(streams.sample_rows(rows[::-1], 10, STREAM_REMOVE)))
+
+        sample = streams.sample(7, STREAM_ALLELES, 20, 5)
+        self.assertEqual(sample, sorted(set(sample)))
+        self.assertEqual(len(sample), 5)
+        self.assertTrue(all(k < 20 for k in sample))
+
+    def test_keyed_pruning(self):
+        legend_header, legend = read_legend('./testData/test.legend')
+        bins = [(1, 1, 25), (2, 2, 2), (3, 5, 2)]
+        kept = []
+        for reverse in [False, True]:
+            M = RowSizes('./testData/test.haps.sm', RowStreams(123))
+            bin_h = assign_bins(M, bins, legend, False, False, False, False)
+            if reverse:
+                for bin_id in bin_h:
+                    bin_h[bin_id].reverse()
+            R = []
+            prune_bins_exact(bin_h, bins, R, M, RowStreams(123))
+            kept.append((get_all_kept_rows(bin_h, R, False, False, False, False, False, None),
+                         M.selections))
+        self.assertEqual(kept[0], kept[1])
+
+        # Allele selections match pruning the loaded matrix with the same stream
+        S = sparse(None)
+        S.load('./testData/test.haps.sm')
+        row = max(range(S.num_rows()), key=S.row_num)
+        alleles = [S.get(row, k) for k in range(S.row_num(row))]
+        M = RowSizes('./testData/test.haps.sm', RowStreams(123))
+        M.prune_row(row, 2)
+        S.prune_row_keyed(row, 2, 123, 0, STREAM_ALLELES)
+        self.assertEqual([alleles[k] for k in M.selections[row]],
+                         [S.get(row, k) for k in range(S.row_num(row))])
+
+    def test_column_index(self):
+        M = sparse(None)
+        M.load('./testData/test.haps.sm')
+        with tempfile.TemporaryDirectory() as d:
+            sm_file = os.path.join(d, 'test.haps.sm')
+            M.write(sm_file)
+            C = load_column_index(sm_file, M)
+            self.assertTrue(os.path.exists(f'{sm_file}.csc'))
+            self.assertEqual(load_column_index(sm_file).row(0), C.row(0))
+
+        self.assertEqual(C.num_rows(), M.num_cols())
+        for col in range(M.num_cols()):
+            carriers = [row for row in range(M.num_rows()) if col in M.row(row)]
+            self.assertEqual(C.row(col), carriers)
+            self.assertEqual(C.row_num(col), len(carriers))
+
+        cols = [0, 3, 5, 19]
+        S = C.subset_cols(cols)
+        self.assertEqual(S.num_rows(), M.num_rows())
+        self.assertEqual(S.num_cols(), len(cols))
+        for row in range(M.num_rows()):
+            self.assertEqual(S.row(row), [cols.index(col) for col in M.row(row) if col in cols])
+
+    def test_index_width(self):
+        M = sparse('./testData/test.haps')
+        self.assertEqual(M.width(), 2)
+        # 32-bit .sm files are narrowed when loaded
+        W = sparse(None)
+        W.load('./testData/test.haps.sm')
+        self.assertEqual(W.width(), 2)
+        with tempfile.TemporaryDirectory() as d:
+            sm_file = os.path.join(d, 'test.haps.sm')
+            M.write(sm_file)
+            self.assertLess(os.path.getsize(sm_file), os.path.getsize('./testData/test.haps.sm'))
+            N = sparse(None)
+            N.load(sm_file)
+            S = RowSizes(sm_file)
+
+        self.assertEqual(N.width(), 2)
+        self.assertEqual((S.num_rows(), S.num_cols()), (M.num_rows(), M.num_cols()))
+        for row in range(M.num_rows()):
+            self.assertEqual(N.row(row), M.row(row))
+            self.assertEqual(N.row(row), W.row(row))
+            self.assertEqual(S.row_num(row), M.row_num(row))
+
+    def test_assign_strata(self):
+        legend_header, legend = read_legend('./testData/SmallExample.stratified.legend')
+        M = RowSizes('./testData/test.haps.sm')
+        bins = read_expected('./testData/testBins.txt')
+        bin_h = assign_bins(M, {'fun': bins, 'syn': bins}, legend, True, False, False, False)
+        strata_h, other_rows = assign_strata(M, [bins, bins], legend, 'fun', ['syn', 'fun'], False)
+        self.assertEqual(other_rows, [])
+        for code, category in enumerate(['syn', 'fun']):
+            self.assertEqual({bin_id: rows for bin_id, rows in strata_h[code].items() if rows},
+                             bin_h[category])
+
+        strata_h, other_rows = assign_strata(M, [bins], legend, 'fun', ['fun'], False)
+        self.assertEqual(other_rows, sorted(row for rows in bin_h['syn'].values() for row in rows))
+
+    def test_prune_strata(self):
+        legend_header, legend = read_legend('./testData/SmallExample.stratified.legend')
+        bins = [[(1, 1, 10), (2, 2, 5), (3, 5, 1)], [(1, 1, 5), (2, 2, 1), (3, 5, 0)]]
+        kept = []
+        selections = []
+        for processes in [1, 2]:
+            M = RowSizes('./testData/test.haps.sm', RowStreams(7))
+            strata_h, other_rows = assign_strata(M, bins, legend, 'fun', ['fun', 'syn'], False)
+            R = prune_strata(strata_h, bins, M, RowStreams(7), True, processes)
+            for code in range(2):
+                self.assertEqual([len(strata_h[code][bin_id]) for bin_id in range(3)],
+                                 [need for lower, upper, need in bins[code]])
+            kept.append(get_strata_kept_rows(strata_h, R, other_rows, False, False, legend))
+            selections.append(M.selections)
+        self.assertEqual(kept[0], kept[1])
+        self.assertEqual(selections[0], selections[1])
+
+    def test_prune_strata_cached(self):
+        legend_header, legend = read_legend('./testData/SmallExample.stratified.legend')
+        bins = [[(1, 1, 10), (2, 2, 5), (3, 5, 1)], [(1, 1, 5), (2, 2, 1), (3, 5, 0)]]
+        M = RowSizes('./testData/test.haps.sm', RowStreams(7))
+        strata_h, other_rows = assign_strata(M, bins, legend, 'fun', ['fun', 'syn'], False)
+        initial = copy.deepcopy(strata_h)
+        R, results = prune_strata_cached(strata_h, bins, M, RowStreams(7), True)
+        with tempfile.TemporaryDirectory() as d:
+            write_state(os.path.join(d, 'state'),
+                        {'initial': initial, 'results': results, 'selections': {}, 'blocks': {}})
+            state = read_state(os.path.join(d, 'state'))
+
+        new_bins = [bins[0], [(1, 1, 4), (2, 2, 1), (3, 5, 0)]]
+        previous = list(zip(bins, state['results']))
+        M = RowSizes('./testData/test.haps.sm', RowStreams(7))
+        strata_h = copy.deepcopy(state['initial'])
+        R, results = prune_strata_cached(strata_h, new_bins, M, RowStreams(7), True,
+                                         previous=previous)
+        self.assertEqual([result['recomputed'] for result in results[0].values()],
+                         [False, False, False])
+        self.assertEqual([results[1][bin_id]['recomputed'] for bin_id in range(3)],
+                         [True, False, False])
+        kept = get_strata_kept_rows(strata_h, R, other_rows, False, False, legend)
+
+        M_full = RowSizes('./testData/test.haps.sm', RowStreams(7))
+        strata_h, other_rows = assign_strata(M_full, new_bins, legend, 'fun', ['fun', 'syn'], False)
+        R = prune_strata(strata_h, new_bins, M_full, RowStreams(7), True)
+        self.assertEqual(kept, get_strata_kept_rows(strata_h, R, other_rows, False, False, legend))
+        self.assertEqual(M.selections, M_full.selections)
+
+    def test_row_sizes(self):
+        M = sparse(None)
+        M.load('./testData/test.haps.sm')
+        S = RowSizes('./testData/test.haps.sm')
+        self.assertEqual(S.num_rows(), M.num_rows())
+        self.assertEqual(S.num_cols(), M.num_cols())
+        for row in range(M.num_rows()):
+            self.assertEqual(S.row_num(row), M.row_num(row))
+        self.assertEqual(S.prune_row(0, 2), 1)
+        self.assertEqual(S.row_num(0), 1)
+
+    def test_lru_cache(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('a', lambda: ('A', 4)), 'A')
+        self.assertEqual(cache.get('b', lambda: ('B', 4)), 'B')
+        self.assertEqual(cache.get('a', lambda: ('X', 4)), 'A')
+        # b is the least recently used
+        self.assertEqual(cache.get('c', lambda: ('C', 4)), 'C')
+        self.assertEqual(cache.get('b', lambda: ('B2', 4)), 'B2')
+        self.assertEqual(cache.metrics(), {'hits': 1, 'misses': 4, 'evictions': 2,
+                                           'entries': 2, 'bytes': 8, 'budget': 10})
+        # An entry larger than the budget is kept until the next one
+        self.assertEqual(cache.get('d', lambda: ('D', 20)), 'D')
+        self.assertEqual(cache.get('d', lambda: ('X', 20)), 'D')
+        self.assertEqual(cache.metrics()['entries'], 1)
+
+        cache = LRUCache(2**20)
+        M = load_row_sizes('./testData/test.haps.sm', cache=cache)
+        M.prune_row(0, 2)
+        N = load_row_sizes('./testData/test.haps.sm', cache=cache)
+        self.assertEqual(N.row_num(0), 3)
+        self.assertEqual(N.selections, {})
+        self.assertIs(load_sparse('./testData/test.haps.sm', cache),
+                      load_sparse('./testData/test.haps.sm', cache))
+        self.assertEqual(cache.metrics()['hits'], 2)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs /proc')
+    def test_lru_cache_frees_evicted_matrices(self):
+        def rss():
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        rows, row_size = 2000, 500
+        with tempfile.TemporaryDirectory() as d:
+            files = [os.path.join(d, f'{i}.sm') for i in range(2)]
+            for sm_file in files:
+                with open(sm_file, 'wb') as f:
+                    f.write(struct.pack('II', rows, 20000))
+                    f.write(array('I', range(row_size, (rows + 1) * row_size, row_size)).tobytes())
+                    f.write(array('I', range(row_size)).tobytes() * rows)
+
+            # Every load evicts the other matrix
+            cache = LRUCache(1)
+            nbytes = load_sparse(files[0], cache).nbytes()
+            before = rss()
+            for i in range(1, 31):
+                load_sparse(files[i % 2], cache)
+            self.assertEqual(cache.metrics()['evictions'], 30)
+            self.assertLess(rss() - before, 4 * nbytes)
+
+    def test_plan_only_prune_bins(self):
+        legend_header, legend = read_legend('./testData/test.legend')
+        bins = read_expected('./testData/testBins.txt')
+        random.seed(123)
+        M = RowSizes('./testData/test.haps.sm')
+        bin_h = assign_bins(M, bins, legend, False, False, False, False)
+        prune_bins(bin_h, bins, [], M)
+        all_kept_rows = get_all_kept_rows(bin_h, [], False, False, False, False, False, None)
+        true_kept_rows = [0, 4, 5, 8, 9, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 23, 25, 27, 28, 29, 30]
+        self.assertEqual(all_kept_rows, true_kept_rows)
+
+    def test_matrix_checksum(self):
+        checksum = matrix_checksum('./testData/test.haps.sm')
+        M = sparse(None)
+        M.load('./testData/test.haps.sm')
+        M.prune_row(0, 1)
+        with tempfile.TemporaryDirectory() as d:
+            sm_file = os.path.join(d, 'test.haps.sm')
+            with open('./testData/test.haps.sm', 'rb') as f, open(sm_file, 'wb') as g:
+                g.write(f.read())
+            self.assertEqual(matrix_checksum(sm_file), checksum)
+            M.write(sm_file)
+            self.assertNotEqual(matrix_checksum(sm_file), checksum)
+
+    def test_plan_round_trip(self):
+        random.seed(123)
+        M = RowSizes('./testData/test.haps.sm')
+        M.prune_row(0, 2)
+        with tempfile.TemporaryDirectory() as d:
+            plan_file = os.path.join(d, 'test.plan')
+            write_plan([0, 5, 9], plan_file, M, 'abc', 123)
+            meta, kept_rows, selections = read_plan(plan_file)
+        self.assertEqual(meta, {'rows': '31', 'cols': '20', 'checksum': 'abc', 'seed': '123',
+                                'replicate': '0'})
+        self.assertEqual(kept_rows, [0, 5, 9])
+        self.assertEqual(selections, M.selections)
+        self.assertEqual(len(selections[0]), 1)
+
+    def test_write_hap_resume(self):
+        M = sparse(None)
+        M.load('./testData/test.haps.sm')
+        rows = list(range(M.num_rows()))
+        selections = {0: [1, 2]}
+        block_rows = header.HAP_BLOCK_ROWS
+        header.HAP_BLOCK_ROWS = 4
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                full = os.path.join(d, 'full.haps.gz')
+                write_hap(rows, full, M, selections)
+                self.assertFalse(os.path.exists(f'{full}.progress'))
+                with gzip.open(full) as f:
+                    lines = f.read().decode().splitlines()
+                self.assertEqual(len(lines), M.num_rows())
+                self.assertEqual(lines[0].split().count('1'), 2)
+
+                # Interrupted after two blocks, partway through the third
+                partial = os.path.join(d, 'partial.haps.gz')
+                blocks = write_hap(rows[:8], partial, M, selections)
+                with open(partial, 'ab') as f:
+                    f.write(b'\x1f\x8b\x08')
+                with open(f'{partial}.progress', 'w') as f:
+                    f.write(f'0\t{blocks[0][1]}\t{blocks[0][2]}\n'
+                            f'1\t{blocks[1][1]}\t{blocks[1][2]}\n2\t')
+                write_hap(rows, partial, M, selections, resume=True)
+                with open(full, 'rb') as f, open(partial, 'rb') as g:
+                    self.assertEqual(gzip.decompress(f.read()), gzip.decompress(g.read()))
+
+                # Started from a different plan
+                other = os.path.join(d, 'other.haps.gz')
+                meta = {'plan': 'abc', 'seed': 1, 'start': 0, 'end': 31}
+                blocks = write_hap(rows[:8], other, M, selections, meta=meta)
+                with open(f'{other}.progress', 'w') as f:
+                    f.write('#plan=abc\tseed=1\tstart=0\tend=31\n'
+                            f'0\t{blocks[0][1]}\t{blocks[0][2]}\n')
+                with self.assertRaises(ProgressMismatch):
+                    write_hap(rows, other, M, selections, resume=True,
+                              meta=dict(meta, plan='def'))
+                write_hap(rows, other, M, selections, resume=True, meta=meta)
+                with open(full, 'rb') as f, open(other, 'rb') as g:
+                    self.assertEqual(gzip.decompress(f.read()), gzip.decompress(g.read()))
+
+                # Progress left behind without the hap file
+                os.remove(partial)
+                with open(f'{partial}.progress', 'w') as f:
+                    f.write('0\t100\t0\n1\t200\t0\n')
+                write_hap(rows, partial, M, selections, resume=True)
+                with open(full, 'rb') as f, open(partial, 'rb') as g:
+                    self.assertEqual(gzip.decompress(f.read()), gzip.decompress(g.read()))
+        finally:
+            header.HAP_BLOCK_ROWS = block_rows
+
+    def test_write_hap_reuse(self):
+        M = sparse(None)
+        M.load('./testData/test.haps.sm')
+        rows = list(range(M.num_rows()))
+        block_rows = header.HAP_BLOCK_ROWS
+        header.HAP_BLOCK_ROWS = 4
+        try:
+            with tempfile.TemporaryDirectory() as d:
+                full = os.path.join(d, 'full.haps.gz')
+                blocks = write_hap(rows, full, M)
+                self.assertEqual(verified_blocks(full, blocks), blocks)
+
+                # A hap file cut short by an interrupted run
+                prev = os.path.join(d, 'prev.haps.gz')
+                with open(full, 'rb') as f, open(prev, 'wb') as g:
+                    g.write(f.read(blocks[3][1] - 1))
+                verified = verified_blocks(prev, blocks)
+                self.assertEqual(set(verified), {0, 1, 2})
+
+                new = os.path.join(d, 'new.haps.gz')
+                new_blocks = write_hap(rows, new, M,
+                                       reuse=(prev, verified, {1}))
+                # Blocks 0 and 2 are copied, the others are written again
+                self.assertEqual(new_blocks[0], blocks[0])
+                self.assertEqual(new_blocks[2], blocks[2])
+                self.assertEqual(verified_blocks(new, new_blocks), new_blocks)
+                with open(full, 'rb') as f, open(new, 'rb') as g:
+                    self.assertEqual(gzip.decompress(f.read()), gzip.decompress(g.read()))
+        finally:
+            header.HAP_BLOCK_ROWS = block_rows
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file